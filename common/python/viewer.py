@@ -11,12 +11,18 @@ The JPEG image is only supported for the O3R platform.
 
 import argparse
 import collections
+import csv
 import logging
+import math
+import threading
 import time
-from functools import partial
-from typing import Callable
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import astuple, dataclass, fields
+from pathlib import Path
+from typing import Any, Callable, List, Optional
 
 import cv2
+import numpy as np
 from ifm3dpy.device import O3R, Device
 from ifm3dpy.framegrabber import FrameGrabber, buffer_id
 
@@ -31,45 +37,292 @@ except ModuleNotFoundError:
     OPEN3D_AVAILABLE = False
 
 
-def get_jpeg(self, img_queue: collections.deque):
-    """Get the JPEG image from the frame
-    and decodes it so it can be displayed.
-    """
-    rgb = cv2.imdecode(self.get_buffer(buffer_id.JPEG_IMAGE), cv2.IMREAD_UNCHANGED)
-    img_queue.append(rgb)
-
+class LatestFrame:
+    """Slot holding the latest frame received.
 
-def get_distance(self, img_queue: collections.deque):
-    """Get the distance image from the frame
-    and normalizes it for display.
+    The frame grabber callback overwrites the frame, so the display
+    always shows the newest one, and waits on a condition variable
+    until a new frame arrives instead of polling. A decoding error
+    is handed over to the display in the same way, and raised by
+    the next get.
     """
+
+    def __init__(self, notify: Optional[threading.Event] = None):
+        """
+        :param notify: optional event set on every new frame, to
+                       wait for the slots of several heads at once
+        """
+        self._condition = threading.Condition()
+        self._frame = None
+        self._count = 0
+        self._taken = 0
+        self._error = None
+        self._notify = notify
+
+    def put(self, frame: Any):
+        """Replace the frame, waking up the display."""
+        with self._condition:
+            self._frame = frame
+            self._count += 1
+            self._condition.notify_all()
+        if self._notify is not None:
+            self._notify.set()
+
+    def fail(self, error: BaseException):
+        """Hand an error over to the display, waking it up."""
+        with self._condition:
+            if self._error is None:
+                self._error = error
+            self._condition.notify_all()
+        if self._notify is not None:
+            self._notify.set()
+
+    def get(self, timeout: Optional[float] = None) -> Optional[Any]:
+        """Wait for a frame newer than the last one returned.
+
+        :param timeout: maximum waiting time in seconds, or None to wait forever
+        :return: the latest frame, or None if no new frame arrived in time
+        :raises: the error of a failed decoding, if any
+        """
+        with self._condition:
+            self._condition.wait_for(
+                lambda: self._count > self._taken or self._error is not None, timeout
+            )
+            if self._error is not None:
+                raise self._error
+            if self._count <= self._taken:
+                return None
+            self._taken = self._count
+            return self._frame
+
+
+def get_jpeg(buffer):
+    """Decode the JPEG image so it can be displayed."""
+    return cv2.imdecode(buffer, cv2.IMREAD_UNCHANGED)
+
+
+def get_distance(buffer):
+    """Normalize the distance image for display."""
     img = cv2.normalize(
-        self.get_buffer(buffer_id.RADIAL_DISTANCE_IMAGE),
+        buffer,
         None,
         0,
         255,
         cv2.NORM_MINMAX,
         cv2.CV_8U,
     )
-    img = cv2.applyColorMap(img, cv2.COLORMAP_JET)
-    img_queue.append(img)
-
-
-def get_amplitude(self, img_queue: collections.deque):
-    """Returns the amplitude data extracted
-    from the frame.
+    return cv2.applyColorMap(img, cv2.COLORMAP_JET)
+
+
+def get_amplitude(buffer):
+    """Returns the amplitude data as is."""
+    return buffer
+
+
+def get_xyz(buffer):
+    """Returns the xyz data as is."""
+    return buffer
+
+
+# Buffer extracted from the frame for each getter
+BUFFER_IDS = {
+    "get_jpeg": buffer_id.JPEG_IMAGE,
+    "get_distance": buffer_id.RADIAL_DISTANCE_IMAGE,
+    "get_amplitude": buffer_id.NORM_AMPLITUDE_IMAGE,
+    "get_xyz": buffer_id.XYZ,
+}
+
+
+@dataclass
+class FrameTimes:
+    """Times of the processing steps of a frame, in seconds since epoch.
+    The transport time, from the reception of the frame by the VPU to its
+    reception by the frame grabber, is only meaningful when the clock of
+    the device is synchronized with the local clock (sNTP)."""
+
+    frame_count: int
+    # Reception of the frame by the VPU (frame.timestamps()),
+    # not the acquisition by the head
+    vpu_received: float
+    # Reception by the frame grabber
+    received: float
+    # End of the decoding of the image
+    decoded: float = float("nan")
+    # Display of the image
+    displayed: float = float("nan")
+
+
+@dataclass
+class DecodedFrame:
+    """Decoded image, along with the times of its processing."""
+
+    image: Any
+    times: FrameTimes
+
+
+class FrameStats:
+    """Rolling frame rate and latency percentiles over the last frames
+    displayed, optionally dumping the times of every frame to a CSV file."""
+
+    def __init__(self, window: int = 100, csv_file: Optional[str] = None):
+        self._times = collections.deque(maxlen=window)
+        self._csv_file = None
+        self._csv_writer = None
+        if csv_file is not None:
+            self._csv_file = open(csv_file, "w", newline="")
+            self._csv_writer = csv.writer(self._csv_file)
+            self._csv_writer.writerow([field.name for field in fields(FrameTimes)])
+
+    def record(self, times: FrameTimes):
+        """Record the times of a displayed frame."""
+        self._times.append(times)
+        if self._csv_writer is not None:
+            self._csv_writer.writerow(astuple(times))
+
+    @property
+    def fps(self) -> float:
+        if len(self._times) < 2:
+            return 0.0
+        elapsed = self._times[-1].displayed - self._times[0].displayed
+        return (len(self._times) - 1) / elapsed if elapsed > 0 else 0.0
+
+    def summary(self) -> List[str]:
+        """Frame rate, then p50/p99 latency of each processing step."""
+        if not self._times:
+            return ["waiting for frames"]
+        lines = [f"{self.fps:.1f} fps"]
+        for name, start, end in [
+            ("total", "received", "displayed"),
+            ("transport", "vpu_received", "received"),
+            ("decode", "received", "decoded"),
+            ("render", "decoded", "displayed"),
+        ]:
+            durations = [getattr(t, end) - getattr(t, start) for t in self._times]
+            p50, p99 = 1000 * np.nanpercentile(durations, [50, 99])
+            lines.append(f"{name} p50 {p50:.1f} ms  p99 {p99:.1f} ms")
+        return lines
+
+    def draw(self, img: np.ndarray, title: Optional[str] = None) -> np.ndarray:
+        """Draw the statistics over an image. 8 bit images are drawn
+        on in place, the other ones are first normalized to 8 bits."""
+        if img.dtype != np.uint8:
+            img = cv2.normalize(img, None, 0, 255, cv2.NORM_MINMAX, cv2.CV_8U)
+        scale = max(img.shape[0] / 800, 0.4)
+        lines = ([title] if title else []) + self.summary()
+        for i, line in enumerate(lines):
+            cv2.putText(
+                img,
+                line,
+                (10, int((i + 1) * 30 * scale)),
+                cv2.FONT_HERSHEY_SIMPLEX,
+                0.8 * scale,
+                (255, 255, 255),
+                max(int(2 * scale), 1),
+                cv2.LINE_AA,
+            )
+        return img
+
+    def close(self):
+        if self._csv_file is not None:
+            self._csv_file.close()
+
+
+class FrameDecoder:
+    """Decode the frames in a pool of worker threads, so that
+    the frame grabber callback returns immediately.
+
+    The callback only extracts the raw buffer from the frame and
+    hands it to the pool. OpenCV releases the GIL, so the frames are
+    decoded in parallel. Frames older than the one displayed are
+    dropped, and so are the ones that fell behind the latest received
+    frames when the decoding cannot keep up.
+
+    The frames are ordered by a local sequence number, not by the
+    device frame count, which restarts when the VPU reboots or the
+    port is restarted.
     """
-    img_queue.append(self.get_buffer(buffer_id.NORM_AMPLITUDE_IMAGE))
 
-
-def get_xyz(self, img_queue: collections.deque):
-    """Returns the xyz data extracted
-    from the frame.
+    def __init__(self, getter: Callable, latest: LatestFrame, workers: int = 2):
+        self._getter = getter
+        self._buffer_id = BUFFER_IDS[getter.__name__]
+        self._latest = latest
+        self._workers = workers
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="decoder"
+        )
+        self._lock = threading.Lock()
+        self._sequence = 0
+        self._received = -1
+        self._displayed = -1
+
+    def on_new_frame(self, frame):
+        """Frame grabber callback: enqueue the raw buffer."""
+        times = FrameTimes(
+            frame_count=frame.frame_count(),
+            vpu_received=frame.timestamps()[0].timestamp(),
+            received=time.time(),
+        )
+        # The callback always runs on the frame grabber thread
+        sequence = self._sequence
+        self._sequence += 1
+        with self._lock:
+            self._received = sequence
+        future = self._executor.submit(
+            self._decode, sequence, times, frame.get_buffer(self._buffer_id)
+        )
+        future.add_done_callback(self._decoded)
+
+    def _decoded(self, future):
+        # Raise the decoding errors in the display loop
+        if not future.cancelled() and future.exception() is not None:
+            self._latest.fail(future.exception())
+
+    def _decode(self, sequence: int, times: FrameTimes, buffer):
+        with self._lock:
+            if (
+                sequence <= self._displayed
+                or sequence <= self._received - self._workers
+            ):
+                return
+        img = self._getter(buffer)
+        with self._lock:
+            # Another worker may have finished a newer frame meanwhile
+            if sequence <= self._displayed:
+                return
+            self._displayed = sequence
+        times.decoded = time.time()
+        self._latest.put(DecodedFrame(img, times))
+
+    def close(self):
+        """Stop decoding, dropping the pending frames."""
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+def update_points(pcd, xyz) -> bool:
+    """Update the points of a point cloud in place from an XYZ image.
+
+    The points are only reallocated when their number changes,
+    otherwise the XYZ image is copied into the existing buffer.
+
+    :return: True if the points were reallocated
     """
-    img_queue.append(self.get_buffer(buffer_id.XYZ))
-
-
-def display_2d(fg: FrameGrabber, getter: Callable, title: str):
+    xyz = xyz.reshape(-1, 3)
+    points = np.asarray(pcd.points)
+    if points.shape == xyz.shape:
+        points[:] = xyz
+        return False
+    pcd.points = open3d.utility.Vector3dVector(xyz)
+    return True
+
+
+def display_2d(
+    fg: FrameGrabber,
+    getter: Callable,
+    title: str,
+    workers: int = 2,
+    stats: Optional[FrameStats] = None,
+    hud: bool = False,
+):
     """Display the requested 2D data (distance, amplitude or JPEG)"""
     if getter.__name__ == "get_jpeg":
         fg.start([buffer_id.JPEG_IMAGE])
@@ -80,51 +333,172 @@ def display_2d(fg: FrameGrabber, getter: Callable, title: str):
                 buffer_id.RADIAL_DISTANCE_IMAGE,
             ]
         )
-    img_queue = collections.deque(maxlen=10)
-    fg.on_new_frame(partial(getter, img_queue=img_queue))
+    latest = LatestFrame()
+    decoder = FrameDecoder(getter, latest, workers)
+    fg.on_new_frame(decoder.on_new_frame)
     time.sleep(3)
 
     cv2.startWindowThread()
     cv2.namedWindow(title, cv2.WINDOW_NORMAL)
-    while True:
-        if img_queue:
-            cv2.imshow(title, img_queue.pop())
-            cv2.waitKey(15)
-
-        if cv2.getWindowProperty(title, cv2.WND_PROP_VISIBLE) < 1:
-            break
-
-    cv2.destroyAllWindows()
-
-
-def display_3d(fg: FrameGrabber, getter: Callable, title: str):
+    try:
+        while True:
+            # Block until a new frame arrives. The timeout only
+            # serves to notice when the window gets closed.
+            frame = latest.get(timeout=0.1)
+            if frame is not None:
+                if hud:
+                    frame.image = stats.draw(frame.image)
+                cv2.imshow(title, frame.image)
+                frame.times.displayed = time.time()
+                if stats is not None:
+                    stats.record(frame.times)
+            cv2.waitKey(1)
+
+            if cv2.getWindowProperty(title, cv2.WND_PROP_VISIBLE) < 1:
+                break
+    finally:
+        decoder.close()
+        cv2.destroyAllWindows()
+
+
+def display_3d(
+    fg: FrameGrabber,
+    getter: Callable,
+    title: str,
+    workers: int = 2,
+    stats: Optional[FrameStats] = None,
+    hud: bool = False,
+):
     """Stream and display the point cloud."""
     fg.start([buffer_id.XYZ])
-    img_queue = collections.deque(maxlen=10)
-    fg.on_new_frame(partial(getter, img_queue=img_queue))
+    latest = LatestFrame()
+    decoder = FrameDecoder(getter, latest, workers)
+    fg.on_new_frame(decoder.on_new_frame)
     time.sleep(3)
     vis = open3d.visualization.Visualizer()
     vis.create_window(title)
 
+    # A single geometry is kept, its points are updated in place
+    pcd = open3d.geometry.PointCloud()
     first = True
-    while True:
-        if img_queue:
-            img = img_queue.pop()
-
-            img = img.reshape(img.shape[0] * img.shape[1], 3)
-            pcd = open3d.geometry.PointCloud()
-            pcd.points = open3d.utility.Vector3dVector(img)
+    last_report = time.time()
+    try:
+        while True:
+            # The timeout keeps the window responsive while waiting
+            frame = latest.get(timeout=0.05)
+            if frame is not None:
+                update_points(pcd, frame.image)
+                if first:
+                    vis.add_geometry(pcd, True)
+                    first = False
+                else:
+                    vis.update_geometry(pcd)
 
-            vis.clear_geometries()
-            vis.add_geometry(pcd, first)
             if not vis.poll_events():
                 break
 
             vis.update_renderer()
+            if frame is not None:
+                frame.times.displayed = time.time()
+                if stats is not None:
+                    stats.record(frame.times)
+                # The statistics cannot be drawn over the point cloud: log them
+                if hud and frame.times.displayed - last_report >= 1:
+                    logging.info(" | ".join(stats.summary()))
+                    last_report = frame.times.displayed
+    finally:
+        decoder.close()
+        vis.destroy_window()
+
+
+# Size of the image of each head in the tiled view (width, height)
+TILE_SIZE = (640, 400)
+
+
+def display_tiled(
+    o3r: O3R,
+    title: str,
+    workers: int = 2,
+    csv_file: Optional[str] = None,
+):
+    """Display the images of all the heads connected to the VPU
+    in a single window: the JPEG image of the 2D heads and the
+    distance image of the 3D heads, with the frame rate and latency
+    of each head. The heads are received and decoded independently,
+    so a slow head does not hold back the other ones.
+
+    The times of the frames of each head are written to a separate
+    CSV file, named after csv_file and the port.
+    """
+    notify = threading.Event()
+    heads = []
+    for port in o3r.ports():
+        if port.type == "2D":
+            getter = get_jpeg
+        elif port.type == "3D":
+            getter = get_distance
+        else:
+            continue  # Skip the IMU
+        fg = FrameGrabber(o3r, pcic_port=port.pcic_port)
+        fg.start([BUFFER_IDS[getter.__name__]])
+        latest = LatestFrame(notify)
+        decoder = FrameDecoder(getter, latest, workers)
+        fg.on_new_frame(decoder.on_new_frame)
+        head_csv_file = None
+        if csv_file is not None:
+            head_csv_file = str(
+                Path(csv_file).with_stem(f"{Path(csv_file).stem}_{port.port}")
+            )
+        heads.append(
+            (port.port, fg, latest, decoder, FrameStats(csv_file=head_csv_file))
+        )
+        logging.info(f"Port: {port.port}   Type: {port.type}")
+    if not heads:
+        raise ValueError("No camera head connected to the VPU.")
 
-            first = False
+    width, height = TILE_SIZE
+    cols = math.ceil(math.sqrt(len(heads)))
+    rows = math.ceil(len(heads) / cols)
+    canvas = np.zeros((rows * height, cols * width, 3), dtype=np.uint8)
 
-    vis.destroy_window()
+    cv2.startWindowThread()
+    cv2.namedWindow(title, cv2.WINDOW_NORMAL)
+    try:
+        while True:
+            # Wake up on the first new frame of any head
+            notify.wait(timeout=0.1)
+            notify.clear()
+            updated = []
+            for i, (name, _, latest, _, stats) in enumerate(heads):
+                frame = latest.get(timeout=0)
+                if frame is None:
+                    continue
+                row, col = divmod(i, cols)
+                tile = canvas[
+                    row * height : (row + 1) * height, col * width : (col + 1) * width
+                ]
+                cv2.resize(
+                    frame.image, TILE_SIZE, dst=tile, interpolation=cv2.INTER_NEAREST
+                )
+                stats.draw(tile, title=name)
+                updated.append((frame, stats))
+
+            if updated:
+                cv2.imshow(title, canvas)
+                displayed = time.time()
+                for frame, stats in updated:
+                    frame.times.displayed = displayed
+                    stats.record(frame.times)
+            cv2.waitKey(1)
+
+            if cv2.getWindowProperty(title, cv2.WND_PROP_VISIBLE) < 1:
+                break
+    finally:
+        for _, fg, _, decoder, stats in heads:
+            decoder.close()
+            fg.stop()
+            stats.close()
+        cv2.destroyAllWindows()
 
 
 def main():
@@ -136,10 +510,10 @@ def main():
 
     parser.add_argument(
         "--image",
-        help="The image to received (default: distance). The jpeg image is only available for the O3R.",
+        help="The image to receive, required unless --tiled is used. The jpeg image is only available for the O3R.",
         type=str,
         choices=image_choices,
-        required=True,
+        required=False,
     )
     parser.add_argument(
         "--ip",
@@ -161,13 +535,43 @@ def main():
         type=str,
         required=False,
     )
+    parser.add_argument(
+        "--workers",
+        help="Number of threads decoding the frames (default: 2)",
+        type=int,
+        required=False,
+        default=2,
+    )
+    parser.add_argument(
+        "--tiled",
+        help="Display the images of all the heads in a single window (for the O3R only)",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--hud",
+        help="Display the frame rate and the latency of each processing step",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--csv",
+        help="CSV file to write the times of each processing step of each frame to",
+        type=str,
+        required=False,
+    )
     args = parser.parse_args()
-
-    getter = globals()["get_" + args.image]
+    if args.image is None and not args.tiled:
+        parser.error("the --image argument is required, unless --tiled is used.")
 
     device = Device(args.ip, args.xmlrpc_port)
     device_type = device.who_am_i()
     logging.info(f"Device type is: {device_type}")
+    if args.tiled:
+        if device_type != device.device_family.O3R:
+            raise ValueError("The tiled view is only supported on the O3R platform.")
+        display_tiled(O3R(args.ip), f"{device_type} viewer", args.workers, args.csv)
+        return
+
+    getter = globals()["get_" + args.image]
     if device_type == device.device_family.O3R:
         if args.port is None:
             raise ValueError("A port should be provided.")
@@ -181,10 +585,15 @@ def main():
 
     title = f"{device_type} viewer"
 
-    if args.image == "xyz":
-        display_3d(fg, getter, title)
-    else:
-        display_2d(fg, getter, title)
+    stats = FrameStats(csv_file=args.csv) if args.hud or args.csv else None
+    try:
+        if args.image == "xyz":
+            display_3d(fg, getter, title, args.workers, stats, args.hud)
+        else:
+            display_2d(fg, getter, title, args.workers, stats, args.hud)
+    finally:
+        if stats is not None:
+            stats.close()
 
 
 if __name__ == "__main__":
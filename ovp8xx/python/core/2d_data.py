@@ -5,20 +5,30 @@
 #############################################
 
 import collections
+import time
 from functools import partial
 from time import perf_counter
+from typing import Optional
 
 import cv2
 from ifm3dpy.device import O3R
 from ifm3dpy.framegrabber import FrameGrabber, buffer_id
+from viewer_stats import FrameStats, frame_times
 
 
-def display(img_queue: collections.deque, timeout: int):
+def display(
+    img_queue: collections.deque,
+    timeout: int,
+    stats: Optional[FrameStats] = None,
+    hud: bool = False,
+):
     """
     Display the images from the queue in a window.
     Args:
         img_queue (collections.deque): Queue containing the images to be displayed.
         timeout (int): Timeout in milliseconds for frame grabbing.
+        stats (FrameStats, optional): Statistics recording the displayed frames.
+        hud (bool): Draw the statistics over the images.
     """
     # Create a window to display the images
     cv2.startWindowThread()
@@ -26,7 +36,13 @@ def display(img_queue: collections.deque, timeout: int):
     start = perf_counter()
     while (perf_counter() - start) * 1000 <= timeout:
         if img_queue:
-            cv2.imshow("2D image", img_queue.pop())
+            rgb, times = img_queue.pop()
+            if hud:
+                rgb = stats.draw(rgb)
+            cv2.imshow("2D image", rgb)
+            times.displayed = time.time()
+            if stats is not None:
+                stats.record(times)
             cv2.waitKey(1)
 
 
@@ -34,14 +50,24 @@ def callback(self, img_queue: collections.deque):
     """Callback function to be called when a new frame is available.
 
     Args:
-        img_queue (collections.deque): Queue to store the images.
+        img_queue (collections.deque): Queue to store the images,
+            along with the times of their processing steps.
     """
+    times = frame_times(self)
     # Get the image from the buffer and decode it
     rgb = cv2.imdecode(self.get_buffer(buffer_id.JPEG_IMAGE), cv2.IMREAD_UNCHANGED)
-    img_queue.append(rgb)
-
-
-def main(ip: str, port: str, queue_length: int, timeout: int):
+    times.decoded = time.time()
+    img_queue.append((rgb, times))
+
+
+def main(
+    ip: str,
+    port: str,
+    queue_length: int,
+    timeout: int,
+    hud: bool = False,
+    csv_file: Optional[str] = None,
+):
     """
     Main function to initialize the O3R device, set the port to RUN state,
     and start streaming frames to a queue.
@@ -50,6 +76,8 @@ def main(ip: str, port: str, queue_length: int, timeout: int):
         port (str): Port name to be set to RUN state.
         queue_length (int): Maximum length of the image queue.
         timeout (int): Timeout in milliseconds for frame grabbing.
+        hud (bool): Display the frame rate and the latency of each processing step.
+        csv_file (str, optional): CSV file to write the times of each frame to.
     """
     # Initialize the O3R device
     o3r = O3R(ip)
@@ -68,14 +96,17 @@ def main(ip: str, port: str, queue_length: int, timeout: int):
     fg.on_new_frame(partial(callback, img_queue=img_queue))
     fg.start([buffer_id.JPEG_IMAGE])
 
+    stats = FrameStats(csv_file=csv_file) if hud or csv_file else None
     try:
         while True:
-            display(img_queue, timeout)
+            display(img_queue, timeout, stats, hud)
     except KeyboardInterrupt:
         print("Exiting...")
 
     # Stop the streaming
     fg.stop()
+    if stats is not None:
+        stats.close()
 
 
 if __name__ == "__main__":
@@ -83,4 +114,15 @@ if __name__ == "__main__":
     PORT = "port0"
     queue_length = 5
     timeout_ms = 300
-    main(ip=IP, port=PORT, queue_length=queue_length, timeout=timeout_ms)
+    # Display the frame rate and latency, and optionally
+    # write the times of each frame to a CSV file
+    HUD = False
+    CSV_FILE = None
+    main(
+        ip=IP,
+        port=PORT,
+        queue_length=queue_length,
+        timeout=timeout_ms,
+        hud=HUD,
+        csv_file=CSV_FILE,
+    )
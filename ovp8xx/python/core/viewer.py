@@ -9,10 +9,17 @@
 
 import argparse
 import asyncio
+import contextlib
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import cv2
+import numpy as np
 from ifm3dpy.device import O3R
 from ifm3dpy.framegrabber import FrameGrabber, buffer_id
+from viewer_stats import FrameStats, frame_times
 
 try:
     import open3d as o3d
@@ -47,56 +54,227 @@ def get_xyz(frame):
     return frame.get_buffer(buffer_id.XYZ)
 
 
-async def display_2d(fg, getter, title):
-    fg.start(
-        [buffer_id.NORM_AMPLITUDE_IMAGE, buffer_id.RADIAL_DISTANCE_IMAGE, buffer_id.XYZ]
-    )
+# Buffers required by each getter: only these are requested
+# from the device, so the other ones are not transmitted.
+BUFFER_IDS = {
+    "get_jpeg": [buffer_id.JPEG_IMAGE],
+    "get_distance": [buffer_id.RADIAL_DISTANCE_IMAGE],
+    "get_amplitude": [buffer_id.NORM_AMPLITUDE_IMAGE],
+    "get_xyz": [buffer_id.XYZ],
+}
+
+
+def update_points(pcd, xyz) -> bool:
+    """Update the points of a point cloud in place from an XYZ image.
+
+    The points are only reallocated when their number changes,
+    otherwise the XYZ image is copied into the existing buffer.
+
+    :return: True if the points were reallocated
+    """
+    xyz = xyz.reshape(-1, 3)
+    points = np.asarray(pcd.points)
+    if points.shape == xyz.shape:
+        points[:] = xyz
+        return False
+    pcd.points = o3d.utility.Vector3dVector(xyz)
+    return True
+
+
+class LatestFrame:
+    """Latest decoded frame, waiting to be rendered. A frame decoded
+    after a newer one is dropped, and the frames not rendered in
+    time are overwritten. A decoding error is handed over to the
+    renderer in the same way, and raised by the next get.
+
+    The frames are ordered by their local sequence number rather than
+    by the device frame count, which restarts when the VPU reboots or
+    the port is restarted."""
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._frame = None
+        self._sequence = -1
+        self._new = False
+        self._error = None
+
+    def put(self, sequence, img, times):
+        with self._condition:
+            if sequence <= self._sequence:
+                return
+            self._frame = (img, times)
+            self._sequence = sequence
+            self._new = True
+            self._condition.notify_all()
+
+    def fail(self, error):
+        with self._condition:
+            if self._error is None:
+                self._error = error
+            self._condition.notify_all()
+
+    def get(self, timeout=None):
+        """Wait for a frame newer than the last one returned.
+
+        Args:
+            timeout (float, optional): maximum waiting time in seconds.
+
+        Returns:
+            tuple: the image and its times, or None if no new frame arrived in time.
+        """
+        with self._condition:
+            self._condition.wait_for(
+                lambda: self._new or self._error is not None, timeout
+            )
+            if self._error is not None:
+                raise self._error
+            if not self._new:
+                return None
+            self._new = False
+            return self._frame
+
+
+async def decode_frame(getter, frame, sequence, times, latest, executor):
+    loop = asyncio.get_running_loop()
+    img = await loop.run_in_executor(executor, getter, frame)
+    times.decoded = time.time()
+    latest.put(sequence, img, times)
+
+
+async def receive_frames(fg, getter, latest, executor, max_decodes):
+    # Only receive here: the decoding runs in the executor, so the
+    # next frame is awaited right away. When all the decoders are
+    # busy, the frame is skipped instead of queued.
+    decoding = set()
+
+    def decoded(task):
+        decoding.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            latest.fail(task.exception())
+
+    try:
+        for sequence in itertools.count():
+            frame = await fg.wait_for_frame()
+            if len(decoding) >= max_decodes:
+                continue
+            task = asyncio.create_task(
+                decode_frame(
+                    getter, frame, sequence, frame_times(frame), latest, executor
+                )
+            )
+            decoding.add(task)
+            task.add_done_callback(decoded)
+    finally:
+        for task in decoding:
+            task.cancel()
+        await asyncio.gather(*decoding, return_exceptions=True)
+
+
+def run_pipeline(fg, getter, render, stats=None, workers=2):
+    """Receive, decode and render the frames concurrently.
+
+    The frames are received by an asyncio loop running in a background
+    thread, and decoded in a thread pool. The rendering stays on the
+    calling (main) thread, as required by the OpenCV and open3d (GLFW)
+    windows. The renderer always takes the latest decoded frame,
+    skipping the stale ones, so the rendering time does not limit the
+    reception rate. A reception or decoding error stops the pipeline
+    and is raised here.
+
+    Args:
+        render (Callable): renders an image, or only processes the window
+            events when given None. Returns False once the window is closed.
+        stats (FrameStats, optional): statistics recording the rendered frames.
+        workers (int): maximum number of frames decoded in parallel.
+    """
+    latest = LatestFrame()
+    loop = asyncio.new_event_loop()
+    decoder = ThreadPoolExecutor(workers)
+    receiver = loop.create_task(receive_frames(fg, getter, latest, decoder, workers))
+
+    def receive():
+        try:
+            loop.run_until_complete(receiver)
+        except asyncio.CancelledError:
+            pass
+        except Exception as error:
+            latest.fail(error)
+        finally:
+            loop.close()
+
+    thread = threading.Thread(target=receive, daemon=True)
+    thread.start()
+    try:
+        while True:
+            # The timeout keeps the window responsive while waiting
+            frame = latest.get(timeout=0.05)
+            img, times = frame if frame is not None else (None, None)
+            if not render(img):
+                break
+            if times is not None:
+                times.displayed = time.time()
+                if stats is not None:
+                    stats.record(times)
+    finally:
+        with contextlib.suppress(RuntimeError):
+            # The loop is already closed if the receiver failed
+            loop.call_soon_threadsafe(receiver.cancel)
+        thread.join()
+        decoder.shutdown(wait=False, cancel_futures=True)
+
+
+def display_2d(fg, getter, title, stats=None, hud=False, workers=2):
+    fg.start(BUFFER_IDS[getter.__name__])
     cv2.startWindowThread()
     cv2.namedWindow(title, cv2.WINDOW_NORMAL)
-    while True:
-        frame = await fg.wait_for_frame()
-
-        img = getter(frame)
-
-        cv2.imshow(title, img)
-        cv2.waitKey(15)
 
-        if cv2.getWindowProperty(title, cv2.WND_PROP_VISIBLE) < 1:
-            break
+    def render(img):
+        if img is not None:
+            if hud:
+                img = stats.draw(img)
+            cv2.imshow(title, img)
+        cv2.waitKey(1)
+        return cv2.getWindowProperty(title, cv2.WND_PROP_VISIBLE) >= 1
 
-    cv2.destroyAllWindows()
+    try:
+        run_pipeline(fg, getter, render, stats, workers)
+    finally:
+        cv2.destroyAllWindows()
 
 
-async def display_3d(fg, getter, title):
-    fg.start(
-        [buffer_id.NORM_AMPLITUDE_IMAGE, buffer_id.RADIAL_DISTANCE_IMAGE, buffer_id.XYZ]
-    )
+def display_3d(fg, getter, title, stats=None, hud=False, workers=2):
+    fg.start(BUFFER_IDS[getter.__name__])
     vis = o3d.visualization.Visualizer()
     vis.create_window(title)
-
-    first = True
-    while True:
-        frame = await fg.wait_for_frame()
-
-        img = getter(frame)
-
-        img = img.reshape(img.shape[0] * img.shape[1], 3)
-        pcd = o3d.geometry.PointCloud()
-        pcd.points = o3d.utility.Vector3dVector(img)
-
-        vis.clear_geometries()
-        vis.add_geometry(pcd, first)
+    # A single geometry is kept, its points are updated in place
+    pcd = o3d.geometry.PointCloud()
+    state = {"first": True, "last_report": time.time()}
+
+    def render(img):
+        if img is not None:
+            update_points(pcd, img)
+            if state["first"]:
+                vis.add_geometry(pcd, True)
+                state["first"] = False
+            else:
+                vis.update_geometry(pcd)
         if not vis.poll_events():
-            break
-
+            return False
         vis.update_renderer()
 
-        first = False
+        # The statistics cannot be drawn over the point cloud: print them
+        if hud and time.time() - state["last_report"] >= 1:
+            print(" | ".join(stats.summary()))
+            state["last_report"] = time.time()
+        return True
 
-    vis.destroy_window()
+    try:
+        run_pipeline(fg, getter, render, stats, workers)
+    finally:
+        vis.destroy_window()
 
 
-async def main():
+def main():
     image_choices = ["jpeg", "distance", "amplitude"]
     if OPEN3D_AVAILABLE:
         image_choices += ["xyz"]
@@ -127,20 +305,40 @@ async def main():
         type=int,
         default=80,
     )
+    parser.add_argument(
+        "--hud",
+        help="Display the frame rate and the latency of each processing step",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--csv",
+        help="CSV file to write the timestamps of each processing step of each frame to",
+        type=str,
+    )
+    parser.add_argument(
+        "--workers",
+        help="Maximum number of frames decoded in parallel (default: 2)",
+        type=int,
+        default=2,
+    )
     args = parser.parse_args()
 
     getter = globals()["get_" + args.image]
 
     cam = O3R(args.ip, args.xmlrpc_port)
     fg = FrameGrabber(cam, pcic_port=args.pcic_port)
-    fg.start()
     title = "O3R Port {}".format(str(args.pcic_port))
 
-    if args.image == "xyz":
-        await display_3d(fg, getter, title)
-    else:
-        await display_2d(fg, getter, title)
+    stats = FrameStats(csv_file=args.csv) if args.hud or args.csv else None
+    try:
+        if args.image == "xyz":
+            display_3d(fg, getter, title, stats, args.hud, args.workers)
+        else:
+            display_2d(fg, getter, title, stats, args.hud, args.workers)
+    finally:
+        if stats is not None:
+            stats.close()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    main()
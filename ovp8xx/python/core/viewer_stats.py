@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+#############################################
+# Copyright 2024-present ifm electronic, gmbh
+# SPDX-License-Identifier: Apache-2.0
+#############################################
+
+#############################################
+# Instrumentation of the viewers: the time of each
+# step of the processing of a frame is recorded, to
+# tell apart the transport, decoding and rendering
+# bottlenecks. All the times are in seconds since epoch.
+# The frame timestamp is the time the VPU received the
+# frame, not the acquisition time (see timestamps.py).
+# The transport time, from this timestamp to the reception
+# by the frame grabber, is only meaningful when the clock
+# of the device is synchronized with the local clock (sNTP).
+
+import collections
+import csv
+import time
+from dataclasses import astuple, dataclass, fields
+from typing import List, Optional
+
+import cv2
+import numpy as np
+
+DEFAULT_WINDOW = 100
+
+
+@dataclass
+class FrameTimes:
+    frame_count: int
+    # Reception of the frame by the VPU (frame.timestamps())
+    vpu_received: float
+    # Reception by the frame grabber
+    received: float
+    # End of the decoding of the image
+    decoded: float = float("nan")
+    # Display of the image
+    displayed: float = float("nan")
+
+
+def frame_times(frame) -> FrameTimes:
+    """Start recording the times of a frame, when it is received.
+
+    Args:
+        frame (ifm3dpy.framegrabber.Frame): frame just received.
+
+    Returns:
+        FrameTimes: times of the frame, to be completed.
+    """
+    return FrameTimes(
+        frame_count=frame.frame_count(),
+        vpu_received=frame.timestamps()[0].timestamp(),
+        received=time.time(),
+    )
+
+
+class FrameStats:
+    """Rolling frame rate and latency percentiles over the last frames,
+    optionally dumping the times of every frame to a CSV file."""
+
+    def __init__(self, window: int = DEFAULT_WINDOW, csv_file: Optional[str] = None):
+        """
+        Args:
+            window (int): number of frames the statistics are computed on.
+            csv_file (str, optional): CSV file to write the times of each frame to.
+        """
+        self._times = collections.deque(maxlen=window)
+        self._csv_file = None
+        self._csv_writer = None
+        if csv_file is not None:
+            self._csv_file = open(csv_file, "w", newline="")
+            self._csv_writer = csv.writer(self._csv_file)
+            self._csv_writer.writerow([field.name for field in fields(FrameTimes)])
+
+    def record(self, times: FrameTimes):
+        """Record the times of a displayed frame."""
+        self._times.append(times)
+        if self._csv_writer is not None:
+            self._csv_writer.writerow(astuple(times))
+
+    @property
+    def fps(self) -> float:
+        if len(self._times) < 2:
+            return 0.0
+        elapsed = self._times[-1].displayed - self._times[0].displayed
+        return (len(self._times) - 1) / elapsed if elapsed > 0 else 0.0
+
+    def _percentiles_ms(self, start: str, end: str) -> np.ndarray:
+        durations = [getattr(t, end) - getattr(t, start) for t in self._times]
+        return 1000 * np.nanpercentile(durations, [50, 99])
+
+    def summary(self) -> List[str]:
+        """Statistics of the last frames, one line per step.
+
+        Returns:
+            List[str]: frame rate, then p50/p99 of the latency of each step.
+        """
+        if not self._times:
+            return ["waiting for frames"]
+        lines = [f"{self.fps:.1f} fps"]
+        for name, start, end in [
+            ("total", "received", "displayed"),
+            ("transport", "vpu_received", "received"),
+            ("decode", "received", "decoded"),
+            ("render", "decoded", "displayed"),
+        ]:
+            p50, p99 = self._percentiles_ms(start, end)
+            lines.append(f"{name} p50 {p50:.1f} ms  p99 {p99:.1f} ms")
+        return lines
+
+    def draw(self, img: np.ndarray) -> np.ndarray:
+        """Draw the statistics over an image. 8 bit images are drawn
+        on in place, the other ones (e.g. the amplitude) are first
+        normalized to 8 bits.
+
+        Returns:
+            np.ndarray: the image with the statistics.
+        """
+        if img.dtype != np.uint8:
+            img = cv2.normalize(img, None, 0, 255, cv2.NORM_MINMAX, cv2.CV_8U)
+        scale = max(img.shape[0] / 800, 0.4)
+        for i, line in enumerate(self.summary()):
+            cv2.putText(
+                img,
+                line,
+                (10, int((i + 1) * 30 * scale)),
+                cv2.FONT_HERSHEY_SIMPLEX,
+                0.8 * scale,
+                (255, 255, 255),
+                max(int(2 * scale), 1),
+                cv2.LINE_AA,
+            )
+        return img
+
+    def close(self):
+        if self._csv_file is not None:
+            self._csv_file.close()
@@ -19,16 +19,27 @@ available, an error will be raised.
 """
 
 import argparse
+import heapq
 import logging
+import struct
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass
+from functools import lru_cache
+from itertools import groupby, repeat
 from os.path import join as path_join
 
 # %%
 from pathlib import Path
+from typing import TYPE_CHECKING, Optional
 
 import h5py
 import numpy as np
-import open3d
+
+# open3d is only needed to write or display the .pcd files
+# with open3d, it is imported by the functions using it.
+if TYPE_CHECKING:
+    import open3d
 
 # Optional import of utilities from another example.
 # This is used in cases where the point cloud data is
@@ -37,11 +48,21 @@ import open3d
 # be calculated from the radial distance image.
 try:
     from o3r_algo_utilities.o3r_uncompress_di import evalIntrinsic
+    from o3r_algo_utilities.rotmat import rotMat
 
     TRANSFORMS_AVAILABLE = True
 except ModuleNotFoundError:
     TRANSFORMS_AVAILABLE = False
 
+# Optional import of the LZF compression, required
+# to write .pcd files in the binary_compressed format.
+try:
+    import lzf
+
+    LZF_AVAILABLE = True
+except ModuleNotFoundError:
+    LZF_AVAILABLE = False
+
 status_logger = logging.getLogger(__name__)
 
 # %%
@@ -55,8 +76,9 @@ class TOFData:
     and provides utilities to convert to pcd format.
     """
 
-    dis: np.ndarray
-    amp: np.ndarray
+    # The images are None when they were not read from the recording
+    dis: Optional[np.ndarray]
+    amp: Optional[np.ndarray]
     width: np.uint16
     height: np.uint16
     frameCounter: np.uint32
@@ -68,15 +90,19 @@ class TOFData:
     extrinsic3D: np.ndarray
     cloud: np.ndarray
     cloud_data: bool
+    # Acquisition timestamp, if recorded
+    timestamp: Optional[int] = None
 
     def pcd_from_numpy_array(self):
         """Format the point cloud to the pcd format.
 
         :return: formatted cloud
         """
+        import open3d
+
         array = self.cloud
-        height = self.dis.shape[0]
-        width = self.dis.shape[1]
+        height = int(self.height)
+        width = int(self.width)
 
         pcd = open3d.geometry.PointCloud()
         xyz = np.reshape(array, (3, height * width))
@@ -93,112 +119,550 @@ class TOFData:
         :return: point cloud
         """
         # Calculate 3D unit vectors corresponding to each pixel
-        # of depth camera
-        ux, uy, uz = evalIntrinsic(
-            self.modelID3D, self.intrinsics3, *self.dis.shape[::-1]
+        # of depth camera. All the frames of a stream share the
+        # same intrinsics, so the unit vectors are cached.
+        height, width = self.dis.shape
+        unit_vectors = unit_vectors_3d(
+            int(self.modelID3D),
+            tuple(np.asarray(self.intrinsics3).tolist()),
+            width,
+            height,
         )
 
         # Multiply unit vectors by depth of corresponding pixel
-        x = (ux * self.dis).flatten()
-        y = (uy * self.dis).flatten()
-        z = (uz * self.dis).flatten()
-        valid = self.dis.flatten() > 0.05
-
-        status_logger.info(f"{round(sum(valid)/x.size*100)}% valid pts")
-        for i, pt_valid in enumerate(valid):
-            if not pt_valid:
-                x[i] = y[i] = z[i] = 0.0
+        dis = self.dis.reshape(1, -1)
+        valid = dis[0] > 0.05
+        status_logger.info(
+            f"{round(np.count_nonzero(valid)/valid.size*100)}% valid pts"
+        )
 
-        # Restructure point cloud as sequence of points
-        pcd_o3 = np.stack((x, y, z), axis=0)
+        # Restructure point cloud as sequence of points,
+        # with the invalid points set to zero.
+        pcd_o3 = unit_vectors * dis
+        pcd_o3[:, ~valid] = 0.0
 
         return pcd_o3
 
 
+@lru_cache(maxsize=16)
+def unit_vectors_3d(modelID3D: int, intrinsics3: tuple, width: int, height: int):
+    """Calculate the unit vectors of the 3D camera, flattened to (3, H*W).
+    The result is cached: pass the intrinsics as a tuple so they are hashable.
+
+    :return: read-only unit vectors
+    """
+    unit_vectors = np.asarray(
+        evalIntrinsic(modelID3D, np.asarray(intrinsics3), width, height)
+    ).reshape(3, -1)
+    unit_vectors.flags.writeable = False
+    return unit_vectors
+
+
+@lru_cache(maxsize=16)
+def rotation_optic_to_user(rot: tuple) -> np.ndarray:
+    """Calculate the optic to user rotation matrix from the
+    rotation angles. The result is cached: pass the angles as a tuple.
+
+    :return: read-only rotation matrix, shape (3, 3)
+    """
+    rotation = np.array(rotMat(*rot), dtype=np.float64)
+    rotation.flags.writeable = False
+    return rotation
+
+
+def transform_to_user(clouds: np.ndarray, extrinsics: np.ndarray) -> np.ndarray:
+    """Transform a stack of point clouds from the optical to the
+    user coordinate system, with a single matrix product for the
+    whole stack. The invalid points stay at zero.
+
+    :param clouds: point clouds in the optical coordinate system,
+                   shape (N, 3, H*W)
+    :param extrinsics: extrinsic optic to user calibration of each cloud,
+                       as stored in TOFData.extrinsic3D
+                       (trans_x, trans_y, trans_z, rot_x, rot_y, rot_z), shape (N, 6)
+    :return: point clouds in the user coordinate system, shape (N, 3, H*W)
+    """
+    extrinsics = np.asarray(extrinsics, dtype=np.float64)
+    rotations = np.stack(
+        [rotation_optic_to_user(tuple(extrinsic[3:])) for extrinsic in extrinsics]
+    )
+    invalid = ~np.any(clouds != 0, axis=1)
+    user_clouds = np.einsum("nij,njk->nik", rotations, clouds)
+    user_clouds += extrinsics[:, :3, np.newaxis]
+    np.copyto(user_clouds, 0.0, where=invalid[:, np.newaxis])
+    return user_clouds.astype(clouds.dtype, copy=False)
+
+
 # %%
 
 
+# Fields read for every frame. The images are read on demand:
+# the distance image is only needed to calculate the point cloud
+# when it was not recorded.
+TOF_METADATA_FIELDS = [
+    "width",
+    "height",
+    "frameCounter",
+    "distanceResolution",
+    "amplitudeResolution",
+    "intrinsicCalibModelID",
+    "intrinsicCalibModelParameters",
+    "invIntrinsicCalibModelParameters",
+    "extrinsicOpticToUserTrans",
+    "extrinsicOpticToUserRot",
+]
+
+
+# Assumed names of the acquisition timestamp field in the streams
+# recorded by the ifm Vision Assistant (iVA). The recording format
+# does not document them: the first one present is used. For fields
+# holding several timestamps (one per exposure), the first one is used.
+TIMESTAMP_FIELDS = ["timestamp_ns", "exposureTimestamps_ns", "timestamp"]
+
+
+def timestamp_field(stream: h5py.Dataset) -> Optional[str]:
+    """Find the name of the timestamp field of a stream, if any.
+
+    The candidates are the assumed iVA field names of TIMESTAMP_FIELDS.
+    """
+    for field in TIMESTAMP_FIELDS:
+        if field in stream.dtype.names:
+            return field
+    return None
+
+
+def tof_stream_names(hf1: h5py.File) -> list:
+    """List the tof streams of a recording."""
+    return [streams for streams in list(hf1["streams"]) if "o3r_tof" in streams]
+
+
+@dataclass
+class FrameSelection:
+    """Selection of the streams and frames to convert. The selection
+    is resolved to frame indices before any image is read, so the
+    frames left out are never read from the disk.
+    """
+
+    # Python slice over the frames of each stream
+    start: Optional[int] = None
+    stop: Optional[int] = None
+    step: Optional[int] = None
+    # Names of the tof streams to convert, all of them if None
+    streams: Optional[list] = None
+    # Window on the acquisition timestamps (inclusive)
+    t_start: Optional[int] = None
+    t_stop: Optional[int] = None
+
+    def stream_names(self, hf1: h5py.File) -> list:
+        """List the selected tof streams of a recording.
+
+        :raises ValueError: if a selected stream is not in the recording
+        """
+        names = tof_stream_names(hf1)
+        if self.streams is None:
+            return names
+        missing = set(self.streams) - set(names)
+        if missing:
+            raise ValueError(f"Streams not found in the recording: {sorted(missing)}")
+        return [name for name in names if name in self.streams]
+
+    def indices(self, stream: h5py.Dataset) -> np.ndarray:
+        """Resolve the selection to the indices of the frames of a stream.
+        For a timestamp window, only the timestamp column is read.
+
+        :raises ValueError: if a timestamp window is requested
+                            but the stream has no timestamp
+        """
+        selected = range(stream.shape[0])[slice(self.start, self.stop, self.step)]
+        indices = np.arange(selected.start, selected.stop, selected.step)
+        if self.t_start is None and self.t_stop is None:
+            return indices
+        field = timestamp_field(stream)
+        if field is None:
+            raise ValueError(f"No timestamp available in {stream.name}")
+        if indices.size == 0:
+            return indices
+        timestamps = stream.fields(field)[
+            selected.start : selected.stop : selected.step
+        ]
+        timestamps = timestamps.reshape(timestamps.shape[0], -1)[:, 0].astype(np.int64)
+        in_window = np.ones(indices.size, dtype=bool)
+        if self.t_start is not None:
+            in_window &= timestamps >= self.t_start
+        if self.t_stop is not None:
+            in_window &= timestamps <= self.t_stop
+        return indices[in_window]
+
+
+def has_cloud_data(stream: h5py.Dataset) -> bool:
+    """Check whether the point cloud was recorded in a tof stream.
+
+    :raises ImportError: if no point cloud data is available and
+                         it cannot be calculated due to missing imports.
+    """
+    if "cloud" in stream.dtype.names:
+        return True
+    status_logger.error(f"No point cloud data available in {stream.name}")
+    if not TRANSFORMS_AVAILABLE:
+        raise ImportError(
+            "Cannot calculate the point cloud due to missing transforms package."
+        )
+    return False
+
+
+def tof_data_from_record(d, cloud_data: bool) -> TOFData:
+    """Unpack a frame read from a tof stream, and calculate
+    the point cloud if it was not recorded."""
+    extrinsic3D = d["extrinsicOpticToUserTrans"]
+    extrinsic3D = np.append(extrinsic3D, d["extrinsicOpticToUserRot"])
+    field_names = d.dtype.names
+    tof_data = TOFData(
+        amp=d["amplitude"] if "amplitude" in field_names else None,
+        dis=d["distance"] if "distance" in field_names else None,
+        amplitudeResolution=d["amplitudeResolution"],
+        distanceResolution=d["distanceResolution"],
+        extrinsic3D=extrinsic3D,
+        cloud=[],
+        frameCounter=d["frameCounter"],
+        height=d["height"],
+        intrinsics3=d["intrinsicCalibModelParameters"],
+        inv_intrinsic3=d["invIntrinsicCalibModelParameters"],
+        modelID3D=d["intrinsicCalibModelID"],
+        width=d["width"],
+        cloud_data=cloud_data,
+    )
+    for field in TIMESTAMP_FIELDS:
+        if field in field_names:
+            tof_data.timestamp = int(np.ravel(d[field])[0])
+            break
+    if cloud_data:
+        tof_data.cloud = d["cloud"]
+    else:
+        tof_data.cloud = tof_data.calc_pointcloud()
+    return tof_data
+
+
+def tof_stream_fields(
+    stream: h5py.Dataset, read_images: bool = False, read_amplitude: bool = False
+):
+    """Select the fields to read from a tof stream.
+
+    :return: list of fields, and availability of cloud data
+    """
+    cloud_data = "cloud" in stream.dtype.names
+    if read_images:
+        fields = TOF_METADATA_FIELDS + ["distance", "amplitude"]
+    else:
+        fields = TOF_METADATA_FIELDS + ([] if cloud_data else ["distance"])
+        if read_amplitude:
+            fields.append("amplitude")
+    if cloud_data:
+        fields.append("cloud")
+    if timestamp_field(stream) is not None:
+        fields.append(timestamp_field(stream))
+    return fields, cloud_data
+
+
+def memmap_dataset(ds: h5py.Dataset) -> Optional[np.memmap]:
+    """Map a dataset directly from the recording file, without going
+    through h5py. Indexing the map returns views on the file data:
+    reading a frame does not decode or copy anything, and the pages
+    read are shared, through the page cache, by all the processes
+    reading the same recording.
+
+    Only uncompressed, contiguous datasets of fixed size records can
+    be mapped, the other ones have to be read with h5py.
+
+    :param ds: dataset of a recording opened from the disk
+    :return: read-only memory map of the dataset, or None if it cannot be mapped
+    """
+    if ds.file.driver not in ("sec2", "stdio"):
+        return None
+    if ds.chunks is not None or ds.compression is not None or ds.dtype.hasobject:
+        return None
+    offset = ds.id.get_offset()
+    if offset is None:
+        # The storage was never allocated (empty dataset)
+        return None
+    # The records must be laid out in the file exactly as in memory
+    file_type = ds.id.get_type()
+    if file_type.get_size() != ds.dtype.itemsize:
+        return None
+    if ds.dtype.names is not None:
+        for i in range(file_type.get_nmembers()):
+            name = file_type.get_member_name(i).decode()
+            if file_type.get_member_offset(i) != ds.dtype.fields[name][1]:
+                return None
+    return np.memmap(
+        ds.file.filename, dtype=ds.dtype, mode="r", offset=offset, shape=ds.shape
+    )
+
+
+def tof_frames_view(stream: h5py.Dataset, fields: list):
+    """Give access to the selected fields of the frames of a stream:
+    a view on the memory mapped file if possible, or else through h5py.
+    """
+    frames = memmap_dataset(stream)
+    if frames is None:
+        return stream.fields(fields)
+    # View on the selected fields only, still without copy
+    return frames[fields]
+
+
+def read_tof_frames(
+    stream: h5py.Dataset,
+    indices,
+    read_images: bool = False,
+    read_amplitude: bool = False,
+    user_coordinates: bool = False,
+    chunk_size: int = 64,
+):
+    """Read the given frames of a tof stream, one at a time.
+
+    :param stream: tof stream of an opened recording.
+    :param indices: indices of the frames to read.
+    :param read_images: also read the distance and amplitude images,
+                        defaults to False
+    :param read_amplitude: also read the amplitude image, defaults to False
+    :param user_coordinates: transform the point clouds calculated from the
+                             distance image to the user coordinate system,
+                             like the recorded ones, defaults to False
+    :param chunk_size: number of frames transformed together, defaults to 64
+    :yield: data class of each frame
+    """
+    fields, cloud_data = tof_stream_fields(stream, read_images, read_amplitude)
+    frames = tof_frames_view(stream, fields)
+    if cloud_data or not user_coordinates:
+        for index in indices:
+            yield tof_data_from_record(frames[index], cloud_data)
+        return
+
+    # The recorded clouds are already in user coordinates. The
+    # calculated ones are transformed a chunk of frames at a time.
+    indices = list(indices)
+    for start in range(0, len(indices), chunk_size):
+        chunk = [
+            tof_data_from_record(frames[index], cloud_data)
+            for index in indices[start : start + chunk_size]
+        ]
+        clouds = transform_to_user(
+            np.stack([tof_data.cloud for tof_data in chunk]),
+            np.stack([tof_data.extrinsic3D for tof_data in chunk]),
+        )
+        for tof_data, cloud in zip(chunk, clouds):
+            tof_data.cloud = cloud
+            yield tof_data
+
+
+def iter_o3r_tof_h5(
+    filename: str,
+    read_images: bool = False,
+    read_amplitude: bool = False,
+    selection: Optional[FrameSelection] = None,
+    user_coordinates: bool = False,
+):
+    """Read an ifm h5 data container (e.g. recording from ifm Vision
+    Assistant) one frame at a time.
+
+    Only the fields needed for the point cloud are read, and a single
+    frame is held in memory at a time, whatever the recording length.
+
+    :param filename (str): filename
+    :param read_images: also read the distance and amplitude images,
+                        defaults to False
+    :param read_amplitude: also read the amplitude image, defaults to False
+    :param selection: streams and frames to read, defaults to all
+    :param user_coordinates: transform the calculated point clouds to
+                             the user coordinate system, defaults to False
+    :raises ImportError: if no point cloud data is available and
+                         it cannot be calculated due to missing imports.
+    :yield: tof stream name and data class of each frame
+    """
+    if selection is None:
+        selection = FrameSelection()
+    with h5py.File(filename, "r") as hf1:
+        status_logger.info(f"data file loaded: {filename}")
+
+        for tof_stream_name in selection.stream_names(hf1):
+            stream = hf1["streams"][tof_stream_name]
+            has_cloud_data(stream)
+            for tof_data in read_tof_frames(
+                stream,
+                selection.indices(stream),
+                read_images=read_images,
+                read_amplitude=read_amplitude,
+                user_coordinates=user_coordinates,
+            ):
+                yield tof_stream_name, tof_data
+
+
 def load_o3r_tof_h5(filename: str) -> list:
     """load data: ifm h5 data container - e.g. recording from ifm Vision Assistant
 
+    All the frames are held in memory: prefer iter_o3r_tof_h5
+    for long recordings. For uncompressed recordings, the images
+    are read-only views on the memory mapped file.
+
     :param filename (str): filename
-    :raises ValueError: if missing data in file
+    :raises ImportError: if missing data in file
     :return list: list of data classes
     """
+    tof_data = []
+    for tof_stream_name, frames in groupby(
+        iter_o3r_tof_h5(filename, read_images=True), key=lambda frame: frame[0]
+    ):
+        tof_data.append({"tof_stream": tof_stream_name, "data": [d for _, d in frames]})
+    return tof_data
 
-    hf1 = h5py.File(filename, "r")
-    status_logger.info(f"data file loaded: {filename}")
 
-    # list all available data keys
-    # hf1["streams"]["o3r_tof_0"][0].dtype
+# %%
 
-    def load_tof_stream_data(tof_stream_name: str, cloud_data=True) -> dict:
-        """Get the point cloud data for a specific tof data stream.
+# Maximum time difference between the frames of the
+# different heads fused into a single point cloud
+DEFAULT_FUSION_TOLERANCE_NS = 20_000_000
 
-        :param tof_stream_name: tof stream name in recording.
-        :param cloud_data: availability of cloud data, defaults to True
-        :raises Exception: if no point cloud data is available and
-                            it cannot be calculated dut to missing imports.
-        :return: data including point cloud.
-        """
-        data = []
-
-        try:
-            _ = hf1["streams"][tof_stream_name][0]["cloud"]
-            cloud_data = True
-        except ValueError:
-            cloud_data = False
-            status_logger.error(f"No point cloud data available in {tof_stream_name}")
-            # raise e
-
-        for d in hf1["streams"][tof_stream_name]:
-            extrinsic3D = d["extrinsicOpticToUserTrans"]
-            extrinsic3D = np.append(extrinsic3D, d["extrinsicOpticToUserRot"])
-            tof_data = TOFData(
-                amp=d["amplitude"],
-                dis=d["distance"],
-                amplitudeResolution=d["amplitudeResolution"],
-                distanceResolution=d["distanceResolution"],
-                extrinsic3D=extrinsic3D,
-                cloud=[],
-                frameCounter=d["frameCounter"],
-                height=d["height"],
-                intrinsics3=d["intrinsicCalibModelParameters"],
-                inv_intrinsic3=d["invIntrinsicCalibModelParameters"],
-                modelID3D=d["intrinsicCalibModelID"],
-                width=d["width"],
-                cloud_data=cloud_data,
-            )
 
-            if cloud_data:
-                tof_data.cloud = d["cloud"]
-            else:
-                if TRANSFORMS_AVAILABLE:
-                    tof_data.cloud = tof_data.calc_pointcloud()
-                else:
-                    tof_data.cloud = np.zeros((tof_data.width, tof_data.height, 3))
-                    cloud_data = False
-                    raise ImportError(
-                        "Cannot calculate the point cloud due to missing transforms package."
-                    )
+@dataclass
+class FusedFrame:
+    """Point clouds of several heads, acquired at the same time
+    and concatenated in the user coordinate system."""
+
+    # Timestamp of the first frame of the time step
+    timestamp: int
+    # Index of the fused frame of each tof stream
+    indices: dict
+    # Concatenated point clouds, shape (3, N)
+    cloud: np.ndarray
+    # Concatenated amplitude images, if read, shape (N,)
+    amp: Optional[np.ndarray] = None
 
-            data.append(tof_data)
 
-        return {"tof_stream": tof_stream_name, "data": data}
+def stream_timestamps(stream: h5py.Dataset, indices: np.ndarray) -> np.ndarray:
+    """Read the timestamps of the given frames of a stream,
+    without reading the image data.
 
-    tof_data = []
-    tof_stream_names = [
-        streams for streams in list(hf1["streams"]) if "o3r_tof" in streams
-    ]
+    :raises ValueError: if the stream has no timestamp
+    """
+    field = timestamp_field(stream)
+    if field is None:
+        raise ValueError(f"No timestamp available in {stream.name}")
+    frames = memmap_dataset(stream)
+    timestamps = stream.fields(field)[:] if frames is None else frames[field]
+    timestamps = np.reshape(timestamps, (stream.shape[0], -1))[:, 0]
+    return timestamps[indices].astype(np.int64)
 
-    for tof_stream_name in tof_stream_names:
-        tof_data.append(load_tof_stream_data(tof_stream_name=tof_stream_name))
 
-    hf1.close()
-    return tof_data
+def match_heads(
+    timestamps: dict,
+    tolerance_ns: int = DEFAULT_FUSION_TOLERANCE_NS,
+    require_all: bool = True,
+):
+    """Group the frames of several heads by acquisition time.
+
+    The frames of all the streams are merged in timestamp order (k-way
+    merge), and a group is closed as soon as a frame is more than
+    tolerance_ns after the first frame of the group, or comes from a
+    stream already in the group. Only the current group is held in memory.
+
+    :param timestamps: frame indices and timestamps of each stream,
+                       as {stream name: (indices, timestamps)}
+    :param require_all: only yield the groups with a frame from every stream
+    :yield: timestamp of the first frame and {stream name: index} of each group
+    """
+    ordered = []
+    for name, (indices, stream_ts) in timestamps.items():
+        order = np.argsort(stream_ts, kind="stable")
+        ordered.append(zip(stream_ts[order].tolist(), repeat(name), indices[order]))
+
+    group = {}
+    start = None
+    for timestamp, name, index in heapq.merge(*ordered):
+        if group and (name in group or timestamp - start > tolerance_ns):
+            if not require_all or len(group) == len(timestamps):
+                yield start, group
+            group = {}
+        if not group:
+            start = timestamp
+        group[name] = int(index)
+    if group and (not require_all or len(group) == len(timestamps)):
+        yield start, group
+
+
+def fuse_o3r_tof_h5(
+    filename: str,
+    tolerance_ns: int = DEFAULT_FUSION_TOLERANCE_NS,
+    read_amplitude: bool = False,
+    selection: Optional[FrameSelection] = None,
+    require_all: bool = True,
+):
+    """Read an ifm h5 data container and fuse the point clouds of all
+    the heads acquired at the same time, one time step at a time.
+
+    The clouds are transformed to the user coordinate system before
+    being concatenated. Only the timestamps are read ahead, the frames
+    are read when their time step is fused.
+
+    :param tolerance_ns: maximum time difference between fused frames
+    :param read_amplitude: also concatenate the amplitude images
+    :param selection: streams and frames to fuse, defaults to all
+    :param require_all: skip the time steps missing a frame of one of the heads
+    :raises ImportError: if no point cloud data is available and
+                         it cannot be calculated due to missing imports.
+    :raises ValueError: if a stream has no timestamp
+    :yield: fused frame of each time step
+    """
+    if selection is None:
+        selection = FrameSelection()
+    with h5py.File(filename, "r") as hf1:
+        status_logger.info(f"data file loaded: {filename}")
+
+        frames = {}
+        timestamps = {}
+        for tof_stream_name in selection.stream_names(hf1):
+            stream = hf1["streams"][tof_stream_name]
+            has_cloud_data(stream)
+            fields, cloud_data = tof_stream_fields(
+                stream, read_amplitude=read_amplitude
+            )
+            frames[tof_stream_name] = (tof_frames_view(stream, fields), cloud_data)
+            indices = selection.indices(stream)
+            timestamps[tof_stream_name] = (
+                indices,
+                stream_timestamps(stream, indices),
+            )
+
+        for timestamp, group in match_heads(timestamps, tolerance_ns, require_all):
+            tof_data = {
+                name: tof_data_from_record(frames[name][0][index], frames[name][1])
+                for name, index in group.items()
+            }
+            # Recorded clouds are already in user coordinates,
+            # the calculated ones are transformed together.
+            calculated = [name for name in group if not frames[name][1]]
+            if calculated:
+                clouds = transform_to_user(
+                    np.stack([tof_data[name].cloud for name in calculated]),
+                    np.stack([tof_data[name].extrinsic3D for name in calculated]),
+                )
+                for name, cloud in zip(calculated, clouds):
+                    tof_data[name].cloud = cloud
+            yield FusedFrame(
+                timestamp=timestamp,
+                indices=group,
+                cloud=np.concatenate(
+                    [np.reshape(d.cloud, (3, -1)) for d in tof_data.values()], axis=1
+                ),
+                amp=(
+                    np.concatenate([np.reshape(d.amp, -1) for d in tof_data.values()])
+                    if read_amplitude
+                    else None
+                ),
+            )
 
 
 def visualize_pcd(path_to_pcd: str) -> None:
+    import open3d
+
     try:
         pcd = open3d.io.read_point_cloud(path_to_pcd, format="pcd")
     except Exception:
@@ -208,7 +672,9 @@ def visualize_pcd(path_to_pcd: str) -> None:
     open3d.visualization.draw_geometries([pcd])
 
 
-def safe_pcd_file(pcd: open3d.cpu.pybind.geometry.PointCloud, filename: str) -> bool:
+def safe_pcd_file(pcd: "open3d.geometry.PointCloud", filename: str) -> bool:
+    import open3d
+
     try:
         open3d.io.write_point_cloud(filename, pcd)
         return True
@@ -217,42 +683,558 @@ def safe_pcd_file(pcd: open3d.cpu.pybind.geometry.PointCloud, filename: str) ->
         return False
 
 
+PCD_DATA_FORMATS = ["binary", "binary_compressed"]
+
+
+def write_pcd(
+    filename: str,
+    xyz: np.ndarray,
+    width: int,
+    height: int,
+    intensity: Optional[np.ndarray] = None,
+    valid: Optional[np.ndarray] = None,
+    data_format: str = "binary",
+) -> None:
+    """Write an organized point cloud to a .pcd file, without
+    going through an open3d point cloud.
+
+    :param xyz: point cloud, shape (3, height * width) or (3, height, width)
+    :param intensity: optional intensity of each point, e.g. the amplitude
+    :param valid: optional validity mask of each point
+    :param data_format: "binary" or "binary_compressed" (requires lzf)
+    :raises ValueError: if the data format is unknown
+    :raises ImportError: if binary_compressed is requested without lzf
+    """
+    if data_format not in PCD_DATA_FORMATS:
+        raise ValueError(f"Unknown PCD data format {data_format}")
+    if data_format == "binary_compressed" and not LZF_AVAILABLE:
+        raise ImportError("The binary_compressed format requires the lzf package.")
+
+    # Columns of the point cloud, each with the PCD field name and type
+    columns = [
+        ("x", "F", np.dtype("<f4"), xyz[0]),
+        ("y", "F", np.dtype("<f4"), xyz[1]),
+        ("z", "F", np.dtype("<f4"), xyz[2]),
+    ]
+    if intensity is not None:
+        columns.append(("intensity", "F", np.dtype("<f4"), intensity))
+    if valid is not None:
+        columns.append(("valid", "U", np.dtype("u1"), valid))
+
+    header = "\n".join(
+        [
+            "# .PCD v0.7 - Point Cloud Data file format",
+            "VERSION 0.7",
+            "FIELDS " + " ".join(name for name, _, _, _ in columns),
+            "SIZE " + " ".join(str(dtype.itemsize) for _, _, dtype, _ in columns),
+            "TYPE " + " ".join(pcd_type for _, pcd_type, _, _ in columns),
+            "COUNT " + " ".join("1" for _ in columns),
+            f"WIDTH {width}",
+            f"HEIGHT {height}",
+            "VIEWPOINT 0 0 0 1 0 0 0",
+            f"POINTS {width * height}",
+            f"DATA {data_format}",
+            "",
+        ]
+    )
+
+    with open(filename, "wb") as f:
+        f.write(header.encode("ascii"))
+        if data_format == "binary":
+            # One record per point: interleave the columns
+            points = np.empty(
+                width * height,
+                dtype=[(name, dtype) for name, _, dtype, _ in columns],
+            )
+            for name, _, _, column in columns:
+                points[name] = np.reshape(column, -1)
+            f.write(points.tobytes())
+        else:
+            # binary_compressed stores the columns one after the other,
+            # the cloud can be written without transposing it.
+            data = b"".join(
+                np.ascontiguousarray(np.reshape(column, -1), dtype=dtype).tobytes()
+                for _, _, dtype, column in columns
+            )
+            compressed = lzf.compress(data, len(data) + len(data) // 16 + 64)
+            if compressed is None:
+                raise ValueError("The point cloud could not be compressed.")
+            f.write(struct.pack("<II", len(compressed), len(data)))
+            f.write(compressed)
+
+
+class H5CloudWriter:
+    """Write all the point clouds of a stream to a single h5 file,
+    one frame at a time. The clouds are stored in a (N, H, W, 3)
+    float32 dataset, chunked by frame and optionally compressed,
+    along with the frameCounter and timestamp columns.
+    """
+
+    def __init__(
+        self, filename: str, n_frames: int, height: int, width: int, compress=True
+    ):
+        self.file = h5py.File(filename, "w")
+        self.n_frames = n_frames
+        self.cloud = self.file.create_dataset(
+            "cloud",
+            shape=(n_frames, height, width, 3),
+            dtype=np.float32,
+            # Without compression, the dataset is contiguous
+            # and can be memory-mapped.
+            chunks=(1, height, width, 3) if compress else None,
+            compression="gzip" if compress else None,
+            shuffle=compress,
+        )
+        self.frame_counter = self.file.create_dataset(
+            "frameCounter", shape=(n_frames,), dtype=np.uint32
+        )
+        self.timestamp = self.file.create_dataset(
+            "timestamp", shape=(n_frames,), dtype=np.int64
+        )
+        self.index = 0
+
+    def write(self, d: TOFData) -> None:
+        height, width = self.cloud.shape[1:3]
+        self.cloud[self.index] = np.reshape(d.cloud, (3, height, width)).transpose(
+            1, 2, 0
+        )
+        self.frame_counter[self.index] = d.frameCounter
+        self.timestamp[self.index] = d.timestamp if d.timestamp is not None else 0
+        self.index += 1
+
+    def close(self) -> None:
+        self.file.close()
+        if self.index != self.n_frames:
+            raise ValueError(
+                f"{self.index} frames written, {self.n_frames} expected: "
+                "the h5 file is incomplete."
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if exc[0] is None:
+            self.close()
+        else:
+            # Do not hide the error interrupting the stream
+            self.file.close()
+
+
+class NpzCloudWriter:
+    """Write all the point clouds of a stream to a single .npz file,
+    one frame at a time. The cloud array is streamed into the archive,
+    the small frameCounter and timestamp columns are added at the end.
+    """
+
+    def __init__(
+        self, filename: str, n_frames: int, height: int, width: int, compress=True
+    ):
+        self.zip = zipfile.ZipFile(
+            filename,
+            "w",
+            compression=zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED,
+            allowZip64=True,
+        )
+        self.shape = (n_frames, height, width, 3)
+        self.cloud = self.zip.open("cloud.npy", "w", force_zip64=True)
+        np.lib.format.write_array_header_2_0(
+            self.cloud,
+            {"descr": "<f4", "fortran_order": False, "shape": self.shape},
+        )
+        self.frame_counter = np.zeros(n_frames, dtype=np.uint32)
+        self.timestamp = np.zeros(n_frames, dtype=np.int64)
+        self.index = 0
+
+    def write(self, d: TOFData) -> None:
+        height, width = self.shape[1:3]
+        cloud = np.reshape(d.cloud, (3, height, width)).transpose(1, 2, 0)
+        self.cloud.write(np.ascontiguousarray(cloud, dtype="<f4").tobytes())
+        self.frame_counter[self.index] = d.frameCounter
+        self.timestamp[self.index] = d.timestamp if d.timestamp is not None else 0
+        self.index += 1
+
+    def close(self) -> None:
+        self.cloud.close()
+        if self.index != self.shape[0]:
+            raise ValueError(
+                f"{self.index} frames written, {self.shape[0]} expected: "
+                "the .npz file is invalid."
+            )
+        for name, array in [
+            ("frameCounter", self.frame_counter),
+            ("timestamp", self.timestamp),
+        ]:
+            with self.zip.open(f"{name}.npy", "w") as f:
+                np.lib.format.write_array(f, array)
+        self.zip.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if exc[0] is None:
+            self.close()
+        else:
+            # Do not hide the error interrupting the stream
+            self.cloud.close()
+            self.zip.close()
+
+
+# Writers of the formats holding all the frames of a stream in a single file
+STREAM_WRITERS = {"h5": H5CloudWriter, "npz": NpzCloudWriter}
+OUTPUT_FORMATS = ["pcd"] + list(STREAM_WRITERS)
+
+
+def save_stream(
+    stream: h5py.Dataset,
+    tof_stream_name: str,
+    parent_file_name: str,
+    directory: Path,
+    output_format: str,
+    compress: bool = True,
+    indices: Optional[np.ndarray] = None,
+    user_coordinates: bool = False,
+) -> int:
+    """Save the point clouds of a tof stream to a single file
+    named after the recording and the tof stream.
+
+    :param output_format: one of STREAM_WRITERS
+    :param indices: indices of the frames to save, defaults to all
+    :param user_coordinates: transform the calculated point clouds to
+                             the user coordinate system, defaults to False
+    :return: number of frames converted
+    """
+    if indices is None:
+        indices = np.arange(stream.shape[0])
+    n_frames = len(indices)
+    if n_frames == 0:
+        return 0
+    size = stream.fields(["height", "width"])[0]
+    filename = f"{parent_file_name}_{tof_stream_name}.{output_format}"
+    status_logger.info(f"saving {n_frames} frames to file {filename}")
+
+    with STREAM_WRITERS[output_format](
+        path_join(directory, filename),
+        n_frames,
+        int(size["height"]),
+        int(size["width"]),
+        compress=compress,
+    ) as writer:
+        for d in read_tof_frames(stream, indices, user_coordinates=user_coordinates):
+            writer.write(d)
+    return n_frames
+
+
+@dataclass
+class CloudFilter:
+    """Stages applied to the point clouds before writing them,
+    in this order: drop the invalid points, crop to an axis aligned
+    box, and downsample on a voxel grid. The filtered clouds are
+    not organized anymore: they are written with a height of 1.
+    """
+
+    # Drop the invalid points (all coordinates set to zero)
+    drop_invalid: bool = False
+    # Corners of the crop box, in the coordinate system of the clouds (m)
+    crop_min: Optional[tuple] = None
+    crop_max: Optional[tuple] = None
+    # Edge length of the voxels (m). Downsampling
+    # also drops the invalid points.
+    voxel_size: Optional[float] = None
+
+    @property
+    def active(self) -> bool:
+        return (
+            self.drop_invalid
+            or self.crop_min is not None
+            or self.crop_max is not None
+            or self.voxel_size is not None
+        )
+
+    def apply(
+        self,
+        xyz: np.ndarray,
+        intensity: Optional[np.ndarray] = None,
+        valid: Optional[np.ndarray] = None,
+    ):
+        """Filter a point cloud, along with the values of its points.
+
+        :param xyz: point cloud, shape (3, N)
+        :param intensity: optional intensity of each point, shape (N,)
+        :param valid: optional validity of each point, shape (N,)
+        :return: filtered point cloud, intensity and validity
+        """
+        intensity = None if intensity is None else np.reshape(intensity, -1)
+        valid = None if valid is None else np.reshape(valid, -1)
+
+        keep = np.ones(xyz.shape[1], dtype=bool)
+        if self.drop_invalid or self.voxel_size is not None:
+            keep &= np.any(xyz != 0, axis=0)
+        if self.crop_min is not None:
+            keep &= np.all(xyz >= np.reshape(self.crop_min, (3, 1)), axis=0)
+        if self.crop_max is not None:
+            keep &= np.all(xyz <= np.reshape(self.crop_max, (3, 1)), axis=0)
+        xyz = xyz[:, keep]
+        intensity = None if intensity is None else intensity[keep]
+        valid = None if valid is None else valid[keep]
+
+        if self.voxel_size is None or xyz.shape[1] == 0:
+            return xyz, intensity, valid
+
+        # Number the voxels and average the points falling in each of them
+        voxels = np.floor(xyz / self.voxel_size).astype(np.int64)
+        voxels -= voxels.min(axis=1, keepdims=True)
+        keys = np.ravel_multi_index(voxels, voxels.max(axis=1) + 1)
+        _, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+        xyz = np.stack(
+            [np.bincount(inverse, weights=coord) / counts for coord in xyz]
+        ).astype(np.float32)
+        if intensity is not None:
+            intensity = (np.bincount(inverse, weights=intensity) / counts).astype(
+                np.float32
+            )
+        if valid is not None:
+            valid = np.ones(counts.size, dtype=bool)
+        return xyz, intensity, valid
+
+
 # %%
 
 
-def main(filename):
-    data = load_o3r_tof_h5(filename=filename)
+def save_frame(
+    tof_stream_name: str,
+    d: TOFData,
+    parent_file_name: str,
+    directory: Path,
+    data_format: str = "binary",
+    intensity: bool = False,
+    valid: bool = False,
+    cloud_filter: Optional[CloudFilter] = None,
+) -> bool:
+    """Save the point cloud of a frame to a .pcd file named
+    after the recording, the tof stream and the frame counter.
+
+    :param intensity: save the amplitude as intensity, which
+                      must have been read with the frame
+    :param valid: save the validity of each point: invalid points
+                  have all their coordinates set to zero
+    :param cloud_filter: optional stages applied to the point cloud
+    """
+    filename = "".join(
+        [
+            parent_file_name,
+            "_",
+            tof_stream_name,
+            "_",
+            str(d.frameCounter),
+            ".pcd",
+        ]
+    )
+    return save_cloud(
+        path_join(directory, filename),
+        d.cloud,
+        int(d.width),
+        int(d.height),
+        d.amp if intensity else None,
+        data_format=data_format,
+        valid=valid,
+        cloud_filter=cloud_filter,
+    )
+
+
+def save_fused_frame(
+    fused: FusedFrame,
+    parent_file_name: str,
+    directory: Path,
+    data_format: str = "binary",
+    intensity: bool = False,
+    valid: bool = False,
+    cloud_filter: Optional[CloudFilter] = None,
+) -> bool:
+    """Save a fused point cloud to a .pcd file named
+    after the recording and the timestamp of the time step.
+
+    :param intensity: save the amplitude as intensity, which
+                      must have been read with the frames
+    """
+    filename = f"{parent_file_name}_fused_{fused.timestamp}.pcd"
+    return save_cloud(
+        path_join(directory, filename),
+        fused.cloud,
+        fused.cloud.shape[1],
+        1,
+        fused.amp if intensity else None,
+        data_format=data_format,
+        valid=valid,
+        cloud_filter=cloud_filter,
+    )
+
+
+def save_cloud(
+    filename: str,
+    cloud: np.ndarray,
+    width: int,
+    height: int,
+    amplitude: Optional[np.ndarray] = None,
+    data_format: str = "binary",
+    valid: bool = False,
+    cloud_filter: Optional[CloudFilter] = None,
+) -> bool:
+    """Filter a point cloud and save it to a .pcd file.
+
+    :return: True if the file was written
+    """
+    xyz = np.reshape(cloud, (3, -1))
+    validity = np.any(xyz != 0, axis=0) if valid else None
+    if cloud_filter is not None and cloud_filter.active:
+        xyz, amplitude, validity = cloud_filter.apply(xyz, amplitude, validity)
+        width, height = xyz.shape[1], 1
+
+    status_logger.info(
+        f"data converted to PCD: start saving the data to file {filename}"
+    )
+
+    try:
+        write_pcd(
+            filename,
+            xyz,
+            width=width,
+            height=height,
+            intensity=amplitude,
+            valid=validity,
+            data_format=data_format,
+        )
+        return True
+    except Exception as e:
+        status_logger.error(e)
+        return False
+
+
+# Recording opened by each worker process of the conversion
+# pool, along with the options of the .pcd files
+_worker_file = {}
+
+
+def _init_worker(filename: str, pcd_options: dict, user_coordinates: bool) -> None:
+    _worker_file["hf1"] = h5py.File(filename, "r")
+    _worker_file["pcd_options"] = pcd_options
+    _worker_file["user_coordinates"] = user_coordinates
+
+
+def _convert_frames(task) -> int:
+    """Convert frames of a tof stream in a worker process.
+
+    :return: number of frames converted
+    """
+    tof_stream_name, indices, parent_file_name, directory = task
+    stream = _worker_file["hf1"]["streams"][tof_stream_name]
+    pcd_options = _worker_file["pcd_options"]
+    for d in read_tof_frames(
+        stream,
+        indices,
+        read_amplitude=pcd_options["intensity"],
+        user_coordinates=_worker_file["user_coordinates"],
+        chunk_size=len(indices),
+    ):
+        save_frame(tof_stream_name, d, parent_file_name, directory, **pcd_options)
+    return len(indices)
+
+
+def main(
+    filename,
+    workers=1,
+    chunk_size=64,
+    output_format="pcd",
+    data_format="binary",
+    intensity=False,
+    valid=False,
+    compress=True,
+    selection=None,
+    cloud_filter=None,
+    user_coordinates=False,
+    fuse=False,
+    tolerance_ns=DEFAULT_FUSION_TOLERANCE_NS,
+):
+    if selection is None:
+        selection = FrameSelection()
+    pcd_options = {
+        "data_format": data_format,
+        "intensity": intensity,
+        "valid": valid,
+        "cloud_filter": cloud_filter,
+    }
     parent_file_name = filename.split(".")[0]
     directory = Path(filename).parent.resolve()
 
     status_logger.info(f"parent filename: {parent_file_name}")
     status_logger.info(f"saving directory: {directory}")
 
-    for tof_stream in data:
-        tof_stream_data = tof_stream["data"]
-        tof_stream_name = tof_stream["tof_stream"]
-
-        for d in tof_stream_data:
-            pcd = d.pcd_from_numpy_array()
-
-            filename = "".join(
-                [
-                    parent_file_name,
-                    "_",
+    if output_format in STREAM_WRITERS:
+        with h5py.File(filename, "r") as hf1:
+            for tof_stream_name in selection.stream_names(hf1):
+                stream = hf1["streams"][tof_stream_name]
+                has_cloud_data(stream)
+                save_stream(
+                    stream,
                     tof_stream_name,
-                    "_",
-                    str(d.frameCounter),
-                    ".pcd",
-                ]
-            )
-            directory_filename = path_join(directory, filename)
+                    parent_file_name,
+                    directory,
+                    output_format,
+                    compress=compress,
+                    indices=selection.indices(stream),
+                    user_coordinates=user_coordinates,
+                )
+        status_logger.info("finished converting")
+        return
 
-            status_logger.info(
-                f"data converted to PCD: start saving the data to file {filename}"
-            )
+    if fuse:
+        for fused in fuse_o3r_tof_h5(
+            filename,
+            tolerance_ns=tolerance_ns,
+            read_amplitude=intensity,
+            selection=selection,
+        ):
+            save_fused_frame(fused, parent_file_name, directory, **pcd_options)
+        status_logger.info("finished converting")
+        return
 
-            safe_pcd_file(filename=directory_filename, pcd=pcd)
+    if workers == 1:
+        for tof_stream_name, d in iter_o3r_tof_h5(
+            filename=filename,
+            read_amplitude=intensity,
+            selection=selection,
+            user_coordinates=user_coordinates,
+        ):
+            save_frame(tof_stream_name, d, parent_file_name, directory, **pcd_options)
         status_logger.info("finished converting")
+        return
+
+    # Only hand frame indices to the workers: each of them opens the
+    # recording itself, so no data is copied between the processes.
+    tasks = []
+    with h5py.File(filename, "r") as hf1:
+        for tof_stream_name in selection.stream_names(hf1):
+            stream = hf1["streams"][tof_stream_name]
+            has_cloud_data(stream)
+            indices = selection.indices(stream).tolist()
+            for start in range(0, len(indices), chunk_size):
+                tasks.append(
+                    (
+                        tof_stream_name,
+                        indices[start : start + chunk_size],
+                        parent_file_name,
+                        directory,
+                    )
+                )
+
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_worker,
+        initargs=(filename, pcd_options, user_coordinates),
+    ) as executor:
+        converted = sum(executor.map(_convert_frames, tasks))
+    status_logger.info(f"finished converting {converted} frames")
 
 
 if __name__ == "__main__":
@@ -261,6 +1243,145 @@ if __name__ == "__main__":
         description="converts ifm HDf5 data files to PCD files",
     )
     parser.add_argument("--filename", default="test_rec.h5")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of processes converting the frames in parallel (default: 1)",
+    )
+    parser.add_argument(
+        "--format",
+        choices=OUTPUT_FORMATS,
+        default="pcd",
+        help="pcd: one .pcd file per frame (default). h5, npz: one file per "
+        "stream, holding the clouds of all the frames as a (N, H, W, 3) "
+        "array, with the frameCounter and timestamp columns.",
+    )
+    parser.add_argument(
+        "--no-compression",
+        action="store_true",
+        help="do not compress the h5 and npz files. Uncompressed h5 "
+        "files can be memory-mapped.",
+    )
+    parser.add_argument(
+        "--pcd-format",
+        choices=PCD_DATA_FORMATS,
+        default="binary",
+        help="data format of the .pcd files (default: binary). "
+        "binary_compressed requires the lzf package.",
+    )
+    parser.add_argument(
+        "--intensity",
+        action="store_true",
+        help="save the amplitude image as the intensity of the points",
+    )
+    parser.add_argument(
+        "--valid",
+        action="store_true",
+        help="save the validity of each point as an additional field",
+    )
+
+    parser.add_argument("--start", type=int, help="index of the first frame")
+    parser.add_argument("--stop", type=int, help="index after the last frame")
+    parser.add_argument("--step", type=int, help="convert every n-th frame")
+    parser.add_argument(
+        "--streams",
+        nargs="+",
+        help="tof streams to convert, e.g. o3r_tof_0 (default: all)",
+    )
+    parser.add_argument(
+        "--t-start",
+        type=int,
+        help="convert the frames acquired at or after this timestamp (ns)",
+    )
+    parser.add_argument(
+        "--t-stop",
+        type=int,
+        help="convert the frames acquired at or before this timestamp (ns)",
+    )
+
+    parser.add_argument(
+        "--drop-invalid",
+        action="store_true",
+        help="do not write the invalid points to the .pcd files",
+    )
+    parser.add_argument(
+        "--crop",
+        nargs=6,
+        type=float,
+        metavar=("X_MIN", "Y_MIN", "Z_MIN", "X_MAX", "Y_MAX", "Z_MAX"),
+        help="only write the points inside this box (m), in the coordinate system "
+        "of the written clouds (see --user-coordinates)",
+    )
+    parser.add_argument(
+        "--voxel-size",
+        type=float,
+        help="downsample the point clouds on a voxel grid of this size (m), "
+        "keeping the mean of the valid points of each voxel",
+    )
+
+    parser.add_argument(
+        "--user-coordinates",
+        action="store_true",
+        help="transform the point clouds calculated from the distance images "
+        "to the user coordinate system. Recorded point clouds are "
+        "already in user coordinates.",
+    )
+
+    parser.add_argument(
+        "--fuse",
+        action="store_true",
+        help="fuse the point clouds of all the heads acquired at the same time "
+        "into a single .pcd file per time step, in user coordinates",
+    )
+    parser.add_argument(
+        "--tolerance-ns",
+        type=int,
+        default=DEFAULT_FUSION_TOLERANCE_NS,
+        help="maximum time difference between the fused frames "
+        f"(default: {DEFAULT_FUSION_TOLERANCE_NS} ns)",
+    )
 
     args = parser.parse_args()
-    main(args.filename)
+    if args.workers < 1:
+        parser.error("--workers must be a positive integer.")
+    if args.format in STREAM_WRITERS and args.workers != 1:
+        parser.error("the h5 and npz formats are written by a single process.")
+    cloud_filter = CloudFilter(
+        drop_invalid=args.drop_invalid,
+        crop_min=tuple(args.crop[:3]) if args.crop else None,
+        crop_max=tuple(args.crop[3:]) if args.crop else None,
+        voxel_size=args.voxel_size,
+    )
+    if args.format in STREAM_WRITERS and cloud_filter.active:
+        parser.error(
+            "the h5 and npz formats store organized point clouds: "
+            "--drop-invalid, --crop and --voxel-size only apply to .pcd files."
+        )
+    if args.voxel_size is not None and args.voxel_size <= 0:
+        parser.error("--voxel-size must be positive.")
+    if args.fuse and (args.format != "pcd" or args.workers != 1):
+        parser.error("--fuse writes .pcd files with a single process.")
+    if args.step is not None and args.step < 1:
+        parser.error("--step must be a positive integer.")
+    main(
+        args.filename,
+        workers=args.workers,
+        output_format=args.format,
+        compress=not args.no_compression,
+        data_format=args.pcd_format,
+        intensity=args.intensity,
+        valid=args.valid,
+        selection=FrameSelection(
+            start=args.start,
+            stop=args.stop,
+            step=args.step,
+            streams=args.streams,
+            t_start=args.t_start,
+            t_stop=args.t_stop,
+        ),
+        cloud_filter=cloud_filter,
+        user_coordinates=args.user_coordinates,
+        fuse=args.fuse,
+        tolerance_ns=args.tolerance_ns,
+    )
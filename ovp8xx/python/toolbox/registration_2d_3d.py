@@ -13,21 +13,38 @@
 # the step by step process along with visualization of the
 # point cloud after each transformation.
 
+# The Registration2D3D class performs the same steps, but caches
+# everything that only depends on the calibration. Use it to colorize
+# the point clouds of a continuous data stream.
+
+# The registration itself only relies on numpy, OpenCV and the
+# o3r_algo_utilities package. The visualization functions import
+# matplotlib and open3d when they are called, so the registration can
+# run headless, for example in a container on the VPU.
+
 # The other functions in this module are helper functions.
 
 # %%
+import collections
 import logging
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
 
 import cv2
-import matplotlib.pyplot as plt
 import numpy as np
-import open3d as o3d
 from o3r_algo_utilities.calib.point_correspondences import inverse_intrinsic_projection
 from o3r_algo_utilities.o3r_uncompress_di import evalIntrinsic
 from o3r_algo_utilities.rotmat import rotMat
 
 logging.getLogger("matplotlib.font_manager").setLevel(logging.ERROR)
 
+# Color given to the 3D pixels that do not project into the 2D image
+DEFAULT_FILL_COLOR = (126, 126, 126)
+# Distance below which a 3D pixel is considered invalid (in meters)
+MIN_VALID_DISTANCE = 0.05
+
 
 # %%#########################################
 # Defining helper functions
@@ -60,6 +77,12 @@ def check_heads_requirements(config: dict, port2d: str, port3d: str):
         raise ValueError("The ports must have different types.")
 
 
+def decode_jpeg(buffer):
+    """Decode a JPEG buffer into a RGB image."""
+    jpg = cv2.imdecode(buffer, cv2.IMREAD_UNCHANGED)
+    return cv2.cvtColor(jpg, cv2.COLOR_BGR2RGB)
+
+
 def collect_data_from_live(port2d: str, port3d: str, ip: str):
     from ifm3dpy.deserialize import RGBInfoV1, TOFInfoV4
     from ifm3dpy.device import O3R
@@ -88,8 +111,7 @@ def collect_data_from_live(port2d: str, port3d: str, ip: str):
 
     # Unpack all data relevant to 2d3d registration
     # Image data (RGB, distance, and amplitude)
-    jpg = cv2.imdecode(frame_2d.get_buffer(buffer_id.JPEG_IMAGE), cv2.IMREAD_UNCHANGED)
-    jpg = cv2.cvtColor(jpg, cv2.COLOR_BGR2RGB)
+    jpg = decode_jpeg(frame_2d.get_buffer(buffer_id.JPEG_IMAGE))
     dis = frame_3d.get_buffer(buffer_id.RADIAL_DISTANCE_IMAGE)
     amp = frame_3d.get_buffer(buffer_id.NORM_AMPLITUDE_IMAGE)
 
@@ -117,19 +139,34 @@ def collect_data_from_live(port2d: str, port3d: str, ip: str):
     )
 
 
+class ExtrinsicOpticToUser:
+    def __init__(self) -> None:
+        self.trans_x = 0.0
+        self.trans_y = 0.0
+        self.trans_z = 0.0
+        self.rot_x = 0.0
+        self.rot_y = 0.0
+        self.rot_z = 0.0
+
+
+def extrinsic_from_rec(record) -> ExtrinsicOpticToUser:
+    """Unpack the extrinsic optic to user calibration
+    of a frame recorded in the ifm h5 format."""
+    extrinsic = ExtrinsicOpticToUser()
+    extrinsic.trans_x = record["extrinsicOpticToUserTrans"][0]
+    extrinsic.trans_y = record["extrinsicOpticToUserTrans"][1]
+    extrinsic.trans_z = record["extrinsicOpticToUserTrans"][2]
+    extrinsic.rot_x = record["extrinsicOpticToUserRot"][0]
+    extrinsic.rot_y = record["extrinsicOpticToUserRot"][1]
+    extrinsic.rot_z = record["extrinsicOpticToUserRot"][2]
+    return extrinsic
+
+
 def collect_data_from_rec(file_path: str):
     import json
 
     import h5py
-
-    class ExtrinsicOpticToUser:
-        def __init__(self) -> None:
-            self.trans_x = 0.0
-            self.trans_y = 0.0
-            self.trans_z = 0.0
-            self.rot_x = 0.0
-            self.rot_y = 0.0
-            self.rot_z = 0.0
+    from h5_to_pcd_converter import memmap_dataset
 
     # Unpack all data required to 2d3d registration
     hf1 = h5py.File(file_path, "r")
@@ -160,30 +197,22 @@ def collect_data_from_rec(file_path: str):
             The same applied to the RGB camera stream."""
         raise ValueError(msg) from e
 
-    jpg = rgb[0]["jpeg"]
-    jpg = cv2.imdecode(jpg, cv2.IMREAD_UNCHANGED)
-    jpg = cv2.cvtColor(jpg, cv2.COLOR_BGR2RGB)
-    invModelID2D = rgb[0]["invIntrinsicCalibModelID"]
-    invIntrinsic2D = rgb[0]["invIntrinsicCalibModelParameters"]
-    extrinsicO2U2D = ExtrinsicOpticToUser()
-    extrinsicO2U2D.trans_x = rgb[0]["extrinsicOpticToUserTrans"][0]
-    extrinsicO2U2D.trans_y = rgb[0]["extrinsicOpticToUserTrans"][1]
-    extrinsicO2U2D.trans_z = rgb[0]["extrinsicOpticToUserTrans"][2]
-    extrinsicO2U2D.rot_x = rgb[0]["extrinsicOpticToUserRot"][0]
-    extrinsicO2U2D.rot_y = rgb[0]["extrinsicOpticToUserRot"][1]
-    extrinsicO2U2D.rot_z = rgb[0]["extrinsicOpticToUserRot"][2]
-
-    dis = tof[0]["distance"]
-    amp = tof[0]["amplitude"]
-    modelID3D = tof[0]["intrinsicCalibModelID"]
-    intrinsics3D = tof[0]["intrinsicCalibModelParameters"]
-    extrinsicO2U3D = ExtrinsicOpticToUser()
-    extrinsicO2U3D.trans_x = tof[0]["extrinsicOpticToUserTrans"][0]
-    extrinsicO2U3D.trans_y = tof[0]["extrinsicOpticToUserTrans"][1]
-    extrinsicO2U3D.trans_z = tof[0]["extrinsicOpticToUserTrans"][2]
-    extrinsicO2U3D.rot_x = tof[0]["extrinsicOpticToUserRot"][0]
-    extrinsicO2U3D.rot_y = tof[0]["extrinsicOpticToUserRot"][1]
-    extrinsicO2U3D.rot_z = tof[0]["extrinsicOpticToUserRot"][2]
+    # Read each record once. The tof record is a view on
+    # the file when the stream can be memory mapped.
+    rgb_record = rgb[0]
+    tof_memmap = memmap_dataset(tof)
+    tof_record = tof[0] if tof_memmap is None else tof_memmap[0]
+
+    jpg = decode_jpeg(rgb_record["jpeg"])
+    invModelID2D = rgb_record["invIntrinsicCalibModelID"]
+    invIntrinsic2D = rgb_record["invIntrinsicCalibModelParameters"]
+    extrinsicO2U2D = extrinsic_from_rec(rgb_record)
+
+    dis = tof_record["distance"]
+    amp = tof_record["amplitude"]
+    modelID3D = tof_record["intrinsicCalibModelID"]
+    intrinsics3D = tof_record["intrinsicCalibModelParameters"]
+    extrinsicO2U3D = extrinsic_from_rec(tof_record)
     hf1.close()
     return (
         jpg,
@@ -198,19 +227,162 @@ def collect_data_from_rec(file_path: str):
     )
 
 
-def plot_point_cloud(pt_cloud, title):
-    #############################################
-    # Some boilerplate for plotting the point clouds
-    #############################################
-    fig = plt.figure(1)
-    plt.clf()
-    ax = fig.add_subplot(projection="3d")
-    plt.plot(*pt_cloud, ".", markersize=1)
-    plt.xlabel("X")
-    plt.ylabel("Y")
-    ax.set_zlabel("Z")
-    plt.title(title)
-    plt.show()
+def _sample_nearest(jpg, pixels_2d, finite, fill_color):
+    # Round the pixel coordinates to the nearest integer.
+    pixels = np.zeros(pixels_2d.shape, dtype=np.intp)
+    pixels[:, finite] = np.round(pixels_2d[:, finite])
+    idY, idX = pixels
+
+    in_image = (
+        finite & (idX >= 0) & (idX < jpg.shape[0]) & (idY >= 0) & (idY < jpg.shape[1])
+    )
+
+    # Get 2D jpg-color for each 3D-pixel, shape is Nx3 (for open3d)
+    colors = np.empty((idX.size, 3), dtype=jpg.dtype)
+    colors[:] = fill_color
+    colors[in_image] = jpg[idX[in_image], idY[in_image], :3]
+    return colors, in_image
+
+
+def _in_image_bilinear(jpg, pixels_2d, finite):
+    # With bilinear interpolation, the pixel coordinates must lie
+    # between the centers of the first and the last pixels.
+    in_image = finite.copy()
+    x, y = pixels_2d[:, finite]
+    in_image[finite] = (
+        (x >= 0) & (x <= jpg.shape[1] - 1) & (y >= 0) & (y <= jpg.shape[0] - 1)
+    )
+    return in_image
+
+
+def _sample_bilinear(jpg, pixels_2d, finite, fill_color):
+    in_image = _in_image_bilinear(jpg, pixels_2d, finite)
+    x, y = pixels_2d[:, in_image]
+
+    # Top left neighbor, clipped so that the bottom right
+    # neighbor is still in the image for the last row and column.
+    x0 = np.minimum(x.astype(np.intp), jpg.shape[1] - 2)
+    y0 = np.minimum(y.astype(np.intp), jpg.shape[0] - 2)
+    fx = (x - x0)[:, np.newaxis]
+    fy = (y - y0)[:, np.newaxis]
+
+    # Gather the four neighbors and blend them
+    img = jpg[..., :3]
+    top = img[y0, x0] * (1 - fx) + img[y0, x0 + 1] * fx
+    bottom = img[y0 + 1, x0] * (1 - fx) + img[y0 + 1, x0 + 1] * fx
+
+    colors = np.empty((pixels_2d.shape[1], 3), dtype=jpg.dtype)
+    colors[:] = fill_color
+    colors[in_image] = np.rint(top * (1 - fy) + bottom * fy)
+    return colors, in_image
+
+
+# cv2.remap only accepts maps smaller than 32767 pixels in
+# each dimension: the coordinates are wrapped in rows of this length.
+_REMAP_ROW_LENGTH = 1024
+
+
+def _sample_remap(jpg, pixels_2d, finite, fill_color):
+    in_image = _in_image_bilinear(jpg, pixels_2d, finite)
+    n_pixels = pixels_2d.shape[1]
+    n_rows = -(-n_pixels // _REMAP_ROW_LENGTH)
+    # Points outside the image are mapped to -1 and get the border value
+    maps = np.full((2, n_rows * _REMAP_ROW_LENGTH), -1, dtype=np.float32)
+    maps[:, :n_pixels][:, in_image] = pixels_2d[:, in_image]
+    map_x, map_y = maps.reshape(2, n_rows, _REMAP_ROW_LENGTH)
+
+    colors = cv2.remap(
+        np.ascontiguousarray(jpg[..., :3]),
+        map_x,
+        map_y,
+        interpolation=cv2.INTER_LINEAR,
+        borderMode=cv2.BORDER_CONSTANT,
+        borderValue=tuple(fill_color),
+    )
+    return colors.reshape(-1, 3)[:n_pixels], in_image
+
+
+SAMPLING_MODES = {
+    "nearest": _sample_nearest,
+    "bilinear": _sample_bilinear,
+    "remap": _sample_remap,
+}
+
+
+def sample_colors(jpg, pixels_2d, fill_color=DEFAULT_FILL_COLOR, sampling="nearest"):
+    """Look up the color of each projected 3D pixel in the 2D image.
+
+    The lookup is done with a single masked gather over the whole
+    image instead of a per pixel loop. Three sampling modes are available:
+    - "nearest": color of the closest 2D pixel,
+    - "bilinear": bilinear interpolation of the four neighboring pixels,
+      which gives smoother colors at the edges of objects,
+    - "remap": bilinear interpolation done by cv2.remap, using the
+      projected coordinates as map.
+
+    :param jpg: decoded 2D image, shape (height, width, channels).
+    :param pixels_2d: floating point pixel coordinates (column, row)
+                      for each 3D pixel, shape (2, N).
+    :param fill_color: color given to the pixels falling outside the image.
+    :param sampling: one of SAMPLING_MODES.
+    :raises ValueError: if the sampling mode is unknown.
+    :return: colors of shape (N, 3) and the mask of the pixels
+             which fall inside the 2D image.
+    """
+    if sampling not in SAMPLING_MODES:
+        raise ValueError(
+            f"Unknown sampling mode {sampling}, expected one of {list(SAMPLING_MODES)}"
+        )
+    # Non finite coordinates (for example for invalid distances)
+    # are flagged before any cast to avoid undefined values.
+    finite = np.isfinite(pixels_2d).all(axis=0)
+    return SAMPLING_MODES[sampling](jpg, pixels_2d, finite, fill_color)
+
+
+# The 3D points are sparser than the 2D pixels: the z-buffer is built
+# on cells of several 2D pixels so that a foreground surface covers
+# the 2D pixels where the background points project (in pixels).
+DEFAULT_OCCLUSION_CELL_SIZE = 4
+# Depth difference above which a point is hidden by the closest
+# point projecting in the same cell (in meters).
+DEFAULT_OCCLUSION_TOLERANCE = 0.05
+
+
+def find_occluded_points(
+    pixels_2d,
+    depth,
+    candidates,
+    image_shape,
+    cell_size=DEFAULT_OCCLUSION_CELL_SIZE,
+    tolerance=DEFAULT_OCCLUSION_TOLERANCE,
+):
+    """Find the 3D points which are hidden, from the point of view of
+    the 2D camera, behind other points of the cloud.
+
+    A z-buffer holding the smallest depth projected in each cell of the
+    2D image is filled with np.minimum.at. Points farther than the
+    z-buffer value of their cell (plus the tolerance) are occluded:
+    the color seen by the 2D camera at their position belongs to a
+    foreground object.
+
+    :param pixels_2d: pixel coordinates (column, row) of each point, shape (2, N).
+    :param depth: depth of each point in the 2D optical CoSy, shape (N,).
+    :param candidates: mask of the points to consider, typically the
+                       valid points projecting inside the image.
+    :param image_shape: (height, width) of the 2D image.
+    :return: mask of the occluded points, shape (N,).
+    """
+    n_cols = -(-image_shape[1] // cell_size)
+    cols, rows = ((pixels_2d[:, candidates] + 0.5) // cell_size).astype(np.intp)
+    cells = rows * n_cols + cols
+    depth = depth[candidates]
+
+    zbuffer = np.full(-(-image_shape[0] // cell_size) * n_cols, np.inf)
+    np.minimum.at(zbuffer, cells, depth)
+
+    occluded = np.zeros(candidates.shape, dtype=bool)
+    occluded[candidates] = depth > zbuffer[cells] + tolerance
+    return occluded
 
 
 def colorize_point_cloud(
@@ -223,6 +395,10 @@ def colorize_point_cloud(
     modelID3D,
     intrinsics3D,
     extrinsicO2U3D,
+    fill_color=DEFAULT_FILL_COLOR,
+    sampling="nearest",
+    handle_occlusions=False,
+    show_plots=True,
 ):
     #############################################
     # Step 1. Calculate the unit vectors for the
@@ -245,10 +421,11 @@ def colorize_point_cloud(
 
     # Log the number of valid points and plot the point cloud
     print(f"shape of point cloud: {pt_cloud_in_3d_opt.shape}")
-    plot_point_cloud(
-        pt_cloud_in_3d_opt[:, valid_points_indices],
-        "Point cloud without extrinsic parameters (3D optical CoSy)",
-    )
+    if show_plots:
+        plot_point_cloud(
+            pt_cloud_in_3d_opt[:, valid_points_indices],
+            "Point cloud without extrinsic parameters (3D optical CoSy)",
+        )
     #############################################
     # Step 3. Transform the point cloud to the
     # user coordinate system using the extrinsic
@@ -284,9 +461,10 @@ def colorize_point_cloud(
 
     # Log the shape of the point cloud and plot it
     print(f"shape of point cloud: {pt_cloud_in_user.shape}")
-    plot_point_cloud(
-        pt_cloud_in_user[:, valid_points_indices], "Point cloud (User CoSy)"
-    )
+    if show_plots:
+        plot_point_cloud(
+            pt_cloud_in_user[:, valid_points_indices], "Point cloud (User CoSy)"
+        )
     #############################################
     # Step 4. Transform the point cloud to the 2D
     # optical coordinate system.
@@ -317,10 +495,11 @@ def colorize_point_cloud(
 
     # Log the shape of the point cloud and plot it
     print(f"shape of point cloud: {pt_cloud_in_2d_opt.shape}")
-    plot_point_cloud(
-        pt_cloud_in_2d_opt[:, valid_points_indices],
-        "Point cloud in 2D optical frame (2D CoSy)",
-    )
+    if show_plots:
+        plot_point_cloud(
+            pt_cloud_in_2d_opt[:, valid_points_indices],
+            "Point cloud in 2D optical frame (2D CoSy)",
+        )
 
     #############################################
     # Step 5. Project the 3D point cloud to the
@@ -335,39 +514,681 @@ def colorize_point_cloud(
         camRefToOpticalSystem={"rot": (0, 0, 0), "trans": (0, 0, 0)},
         binning=0,
     )
-    # Round the pixel coordinates to the nearest integer
-    corresponding_pixels_2d = np.round(corresponding_pixels_2d).astype(int)
 
     #############################################
     # Step 6. Get the color value for each 3D pixel
     #############################################
-    idX = corresponding_pixels_2d[1]
-    idY = corresponding_pixels_2d[0]
-
-    # Get 2D jpg-color for each 3D-pixel
-    colors = np.zeros((len(idX), 3))  # shape is Nx3 (for open3d)
-    count = 0
-    for i in range(0, len(colors)):
-        if idX[i] >= jpg.shape[0] or idY[i] >= jpg.shape[1] or idX[i] < 0 or idY[i] < 0:
-            colors[i, 0] = 126
-            colors[i, 1] = 126
-            colors[i, 2] = 126
-            count += 1
-        else:
-            colors[i, 0] = jpg[idX[i], idY[i], 0]
-            colors[i, 1] = jpg[idX[i], idY[i], 1]
-            colors[i, 2] = jpg[idX[i], idY[i], 2]
+    colors, in_image = sample_colors(jpg, corresponding_pixels_2d, fill_color, sampling)
 
+    count = np.count_nonzero(~in_image)
     print(f"Invalid pixels (usually objects too far or too dim): {count}")
 
+    #############################################
+    # Step 7 (optional). Points hidden from the 2D
+    # camera by a foreground object would get the
+    # color of this object: give them the fill color.
+    #############################################
+    if handle_occlusions:
+        occluded = find_occluded_points(
+            corresponding_pixels_2d,
+            pt_cloud_in_2d_opt[2],
+            in_image & (dis.flatten() > MIN_VALID_DISTANCE),
+            jpg.shape[:2],
+        )
+        colors[occluded] = fill_color
+        print(f"Occluded pixels: {np.count_nonzero(occluded)}")
+
     return pt_cloud_in_user, colors
 
 
+def depth_to_2d(
+    image_shape,
+    dis,
+    invModelID2D,
+    invIntrinsic2D,
+    extrinsicO2U2D,
+    modelID3D,
+    intrinsics3D,
+    extrinsicO2U3D,
+    fill_holes=False,
+):
+    """Reverse registration: render the distance image into the 2D
+    image frame, to obtain a depth image aligned with the 2D image.
+    The transformations are the same as in colorize_point_cloud().
+    See Registration2D3D.depth_to_2d for the details.
+
+    :param image_shape: (height, width) of the 2D image.
+    :return: depth image aligned with the 2D image, 0 where
+             no depth is available.
+    """
+    registration = Registration2D3D(
+        invModelID2D,
+        invIntrinsic2D,
+        extrinsicO2U2D,
+        modelID3D,
+        intrinsics3D,
+        extrinsicO2U3D,
+    )
+    return registration.depth_to_2d(dis, image_shape, fill_holes=fill_holes)
+
+
+# %%#########################################
+# Registration for continuous use
+#############################################
+def _extrinsic_to_tuple(extrinsic):
+    """Returns the (rot, trans) pair of an extrinsic optic to user
+    calibration, as hashable tuples."""
+    return (
+        (float(extrinsic.rot_x), float(extrinsic.rot_y), float(extrinsic.rot_z)),
+        (float(extrinsic.trans_x), float(extrinsic.trans_y), float(extrinsic.trans_z)),
+    )
+
+
+def calibration_from_info(rgb_info, tof_info):
+    """Extract the calibration relevant to the registration
+    from the deserialized RGBInfoV1 and TOFInfoV4 buffers.
+
+    :return: the calibration, in the order expected by Registration2D3D.
+    """
+    return (
+        rgb_info.inverse_intrinsic_calibration.model_id,
+        rgb_info.inverse_intrinsic_calibration.parameters,
+        rgb_info.extrinsic_optic_to_user,
+        tof_info.intrinsic_calibration.model_id,
+        tof_info.intrinsic_calibration.parameters,
+        tof_info.extrinsic_optic_to_user,
+    )
+
+
+class Registration2D3D:
+    """Registration of the 2D and 3D images of a camera head,
+    meant to be used for every frame of a data stream.
+
+    The steps are the same as in colorize_point_cloud(), but everything
+    that only depends on the calibration (the unit vectors, the
+    rotation matrices and the rigid transform between the 3D and the
+    2D optical frames) is computed once and cached. The cache is only
+    refreshed when the calibration or the image size changes.
+    """
+
+    def __init__(
+        self,
+        invModelID2D,
+        invIntrinsic2D,
+        extrinsicO2U2D,
+        modelID3D,
+        intrinsics3D,
+        extrinsicO2U3D,
+        fill_color=DEFAULT_FILL_COLOR,
+        sampling="nearest",
+        handle_occlusions=False,
+    ):
+        if sampling not in SAMPLING_MODES:
+            raise ValueError(
+                f"Unknown sampling mode {sampling}, expected one of {list(SAMPLING_MODES)}"
+            )
+        self.fill_color = fill_color
+        self.sampling = sampling
+        self.handle_occlusions = handle_occlusions
+        self._calibration = None
+        self._shape = None
+        self.update(
+            invModelID2D,
+            invIntrinsic2D,
+            extrinsicO2U2D,
+            modelID3D,
+            intrinsics3D,
+            extrinsicO2U3D,
+        )
+
+    @classmethod
+    def from_info(cls, rgb_info, tof_info, **kwargs):
+        """Create the registration from the deserialized
+        RGBInfoV1 and TOFInfoV4 buffers. The keyword arguments
+        are passed to the constructor."""
+        return cls(*calibration_from_info(rgb_info, tof_info), **kwargs)
+
+    def update_from_info(self, rgb_info, tof_info) -> bool:
+        """Update the calibration from the deserialized
+        RGBInfoV1 and TOFInfoV4 buffers.
+
+        :return: True if the calibration changed.
+        """
+        return self.update(*calibration_from_info(rgb_info, tof_info))
+
+    def update(
+        self,
+        invModelID2D,
+        invIntrinsic2D,
+        extrinsicO2U2D,
+        modelID3D,
+        intrinsics3D,
+        extrinsicO2U3D,
+    ) -> bool:
+        """Update the calibration. The cached transformations are
+        only recomputed if one of the parameters changed.
+
+        :return: True if the calibration changed.
+        """
+        calibration = (
+            int(invModelID2D),
+            tuple(float(p) for p in invIntrinsic2D),
+            _extrinsic_to_tuple(extrinsicO2U2D),
+            int(modelID3D),
+            tuple(float(p) for p in intrinsics3D),
+            _extrinsic_to_tuple(extrinsicO2U3D),
+        )
+        if calibration == self._calibration:
+            return False
+        self._calibration = calibration
+        rot_2d, trans_2d = calibration[2]
+        rot_3d, trans_3d = calibration[5]
+
+        # 3D optical CoSy to user CoSy
+        self._rot_3d_to_user = np.array(rotMat(*rot_3d))
+        self._trans_3d_to_user = np.array(trans_3d)[..., np.newaxis]
+        # 3D optical CoSy to 2D optical CoSy, going through the user CoSy
+        rot_2d_to_user = np.array(rotMat(*rot_2d))
+        self._rot_3d_to_2d = rot_2d_to_user.T.dot(self._rot_3d_to_user)
+        self._trans_3d_to_2d = rot_2d_to_user.T.dot(
+            np.array(trans_3d) - np.array(trans_2d)
+        )[..., np.newaxis]
+
+        self._inv_ic_2d = {"modelID": invModelID2D, "modelParameters": invIntrinsic2D}
+        # The unit vectors depend on the image size,
+        # they are computed with the first distance image.
+        self._shape = None
+        return True
+
+    def _update_unit_vectors(self, shape):
+        if shape == self._shape:
+            return
+        modelID3D, intrinsics3D = self._calibration[3], self._calibration[4]
+        unit_vectors_3d_in_3d_opt = np.asarray(
+            evalIntrinsic(modelID3D, intrinsics3D, *shape[::-1])
+        ).reshape(3, -1)
+        # Rotate the unit vectors once, the translation is
+        # applied after scaling with the distance.
+        self._unit_vectors_in_user = self._rot_3d_to_user.dot(unit_vectors_3d_in_3d_opt)
+        self._unit_vectors_in_2d_opt = self._rot_3d_to_2d.dot(unit_vectors_3d_in_3d_opt)
+        self._shape = shape
+
+    def colorize(self, jpg, dis):
+        """Colorize the point cloud computed from the distance image.
+
+        :param jpg: decoded RGB image.
+        :param dis: radial distance image.
+        :return: the point cloud in the user CoSy, shape (3, N),
+                 and the corresponding colors, shape (N, 3).
+        """
+        self._update_unit_vectors(dis.shape)
+        dis = dis.reshape(1, -1)
+        pt_cloud_in_user = self._unit_vectors_in_user * dis + self._trans_3d_to_user
+        pt_cloud_in_2d_opt = self._unit_vectors_in_2d_opt * dis + self._trans_3d_to_2d
+
+        corresponding_pixels_2d = inverse_intrinsic_projection(
+            camXYZ=pt_cloud_in_2d_opt,
+            invIC=self._inv_ic_2d,
+            camRefToOpticalSystem={"rot": (0, 0, 0), "trans": (0, 0, 0)},
+            binning=0,
+        )
+        colors, in_image = sample_colors(
+            jpg, corresponding_pixels_2d, self.fill_color, self.sampling
+        )
+        if self.handle_occlusions:
+            occluded = find_occluded_points(
+                corresponding_pixels_2d,
+                pt_cloud_in_2d_opt[2],
+                in_image & (dis[0] > MIN_VALID_DISTANCE),
+                jpg.shape[:2],
+            )
+            colors[occluded] = self.fill_color
+        return pt_cloud_in_user, colors
+
+    def depth_to_2d(self, dis, image_shape, fill_holes=False):
+        """Render the distance image into the 2D image frame.
+
+        The 3D points are transformed to the 2D optical CoSy and
+        scattered to the 2D pixels they project to. When several points
+        project to the same pixel, the closest one is kept.
+
+        :param dis: radial distance image.
+        :param image_shape: (height, width) of the 2D image.
+        :param fill_holes: the 2D image has many more pixels than the
+                           distance image, so most pixels get no point.
+                           If True, the holes are filled with the closest
+                           depth found in a 5x5 neighborhood.
+        :return: depth image (z coordinate in the 2D optical CoSy) aligned
+                 with the 2D image, 0 where no depth is available.
+        """
+        self._update_unit_vectors(dis.shape)
+        dis = dis.reshape(1, -1)
+        pt_cloud_in_2d_opt = self._unit_vectors_in_2d_opt * dis + self._trans_3d_to_2d
+        # Points behind the 2D camera cannot be projected
+        valid = (dis[0] > MIN_VALID_DISTANCE) & (pt_cloud_in_2d_opt[2] > 0)
+        pt_cloud_in_2d_opt = pt_cloud_in_2d_opt[:, valid]
+
+        corresponding_pixels_2d = inverse_intrinsic_projection(
+            camXYZ=pt_cloud_in_2d_opt,
+            invIC=self._inv_ic_2d,
+            camRefToOpticalSystem={"rot": (0, 0, 0), "trans": (0, 0, 0)},
+            binning=0,
+        )
+        finite = np.isfinite(corresponding_pixels_2d).all(axis=0)
+        cols, rows = np.round(corresponding_pixels_2d[:, finite]).astype(np.intp)
+        depth = pt_cloud_in_2d_opt[2, finite]
+        in_image = (
+            (rows >= 0)
+            & (rows < image_shape[0])
+            & (cols >= 0)
+            & (cols < image_shape[1])
+        )
+
+        # Scatter the depth values, keeping the closest point for each pixel.
+        # Empty pixels hold the largest float, which is also the value
+        # cv2.erode uses outside of the image.
+        empty = np.finfo(np.float32).max
+        depth_2d = np.full(image_shape[0] * image_shape[1], empty, dtype=np.float32)
+        np.minimum.at(
+            depth_2d,
+            rows[in_image] * image_shape[1] + cols[in_image],
+            depth[in_image],
+        )
+        depth_2d = depth_2d.reshape(image_shape)
+
+        if fill_holes:
+            # Minimum filter: holes get the closest neighboring depth
+            holes = depth_2d == empty
+            depth_2d[holes] = cv2.erode(depth_2d, np.ones((5, 5), np.uint8))[holes]
+
+        depth_2d[depth_2d == empty] = 0
+        return depth_2d
+
+
+# %%#########################################
+# Streaming colored point clouds from live data
+#############################################
+# Maximum time difference between a 2D and a 3D
+# frame to be registered together (in ns).
+DEFAULT_TOLERANCE_NS = 50_000_000
+
+
+@dataclass
+class ColoredPointCloud:
+    """A colored point cloud, as yielded by stream_colored_point_clouds."""
+
+    timestamp_ns: int
+    points: np.ndarray
+    colors: np.ndarray
+    valid: np.ndarray
+
+
+def _pop_matching_pair(queue_2d, queue_3d, tolerance_ns):
+    """Pop the oldest pair of 2D and 3D frames whose timestamps
+    differ by less than the tolerance. The frames older than the
+    pair, which cannot be matched anymore, are discarded.
+
+    :return: the 2D and the 3D entries, or None if no pair is available.
+    """
+    while queue_2d and queue_3d:
+        ts_2d = queue_2d[0][0]
+        ts_3d = queue_3d[0][0]
+        if abs(ts_2d - ts_3d) <= tolerance_ns:
+            return queue_2d.popleft(), queue_3d.popleft()
+        # Frames arrive in order: the oldest of the two heads
+        # cannot be matched with any later frame.
+        if ts_2d < ts_3d:
+            queue_2d.popleft()
+        else:
+            queue_3d.popleft()
+    return None
+
+
+def stream_colored_point_clouds(
+    ip: str,
+    port2d: str,
+    port3d: str,
+    tolerance_ns: int = DEFAULT_TOLERANCE_NS,
+    queue_size: int = 2,
+    timeout_ms: int = 1000,
+):
+    """Continuously yield colored point clouds from live data.
+
+    The 2D and 3D frames are received in the FrameGrabber callbacks
+    and paired by the acquisition timestamps found in the RGB_INFO and
+    TOF_INFO buffers. The frames are kept in bounded queues: if the
+    consumer is slower than the camera, the oldest frames are dropped,
+    which keeps the latency constant.
+
+    :param tolerance_ns: maximum time difference between
+                         a 2D and a 3D frame to be registered together.
+    :param queue_size: number of frames buffered for each port.
+    :param timeout_ms: maximum time to wait for a pair of frames.
+    :raises TimeoutError: if no pair of frames is received within the timeout.
+    :yield: ColoredPointCloud, with the timestamp of the 3D frame.
+    """
+    from ifm3dpy.deserialize import RGBInfoV1, TOFInfoV4
+    from ifm3dpy.device import O3R
+    from ifm3dpy.framegrabber import FrameGrabber, buffer_id
+
+    o3r = O3R(ip)
+    check_heads_requirements(config=o3r.get(), port2d=port2d, port3d=port3d)
+
+    queue_2d = collections.deque(maxlen=queue_size)
+    queue_3d = collections.deque(maxlen=queue_size)
+    new_frame = threading.Condition()
+
+    # The callbacks only deserialize the small info buffers,
+    # the heavy lifting is done in the generator.
+    def on_new_2d_frame(frame):
+        rgb_info = RGBInfoV1().deserialize(frame.get_buffer(buffer_id.RGB_INFO))
+        with new_frame:
+            queue_2d.append((int(rgb_info.timestamp_ns), frame, rgb_info))
+            new_frame.notify()
+
+    def on_new_3d_frame(frame):
+        tof_info = TOFInfoV4().deserialize(frame.get_buffer(buffer_id.TOF_INFO))
+        with new_frame:
+            # The first timestamp is the one of the last exposure
+            queue_3d.append((int(tof_info.exposure_timestamps_ns[0]), frame, tof_info))
+            new_frame.notify()
+
+    fg_2d = FrameGrabber(o3r, o3r.port(port2d).pcic_port)
+    fg_3d = FrameGrabber(o3r, o3r.port(port3d).pcic_port)
+    fg_2d.on_new_frame(on_new_2d_frame)
+    fg_3d.on_new_frame(on_new_3d_frame)
+    fg_2d.start([buffer_id.JPEG_IMAGE, buffer_id.RGB_INFO])
+    fg_3d.start([buffer_id.RADIAL_DISTANCE_IMAGE, buffer_id.TOF_INFO])
+
+    registration = None
+    try:
+        while True:
+            with new_frame:
+                if not new_frame.wait_for(
+                    lambda: queue_2d and queue_3d, timeout=timeout_ms / 1000
+                ):
+                    raise TimeoutError("No frame was collected.")
+                pair = _pop_matching_pair(queue_2d, queue_3d, tolerance_ns)
+            if pair is None:
+                continue
+            (_, frame_2d, rgb_info), (timestamp_ns, frame_3d, tof_info) = pair
+
+            if registration is None:
+                registration = Registration2D3D.from_info(rgb_info, tof_info)
+            else:
+                registration.update_from_info(rgb_info, tof_info)
+
+            jpg = decode_jpeg(frame_2d.get_buffer(buffer_id.JPEG_IMAGE))
+            dis = frame_3d.get_buffer(buffer_id.RADIAL_DISTANCE_IMAGE)
+            points, colors = registration.colorize(jpg, dis)
+            yield ColoredPointCloud(
+                timestamp_ns=timestamp_ns,
+                points=points,
+                colors=colors,
+                valid=dis.flatten() > MIN_VALID_DISTANCE,
+            )
+    finally:
+        fg_2d.stop()
+        fg_3d.stop()
+
+
+# %%#########################################
+# Batch registration of recordings
+#############################################
+# Calibration fields read from the TOF stream for each frame,
+# the point cloud and the amplitude image are not needed.
+TOF_REC_FIELDS = [
+    "distance",
+    "frameCounter",
+    "intrinsicCalibModelID",
+    "intrinsicCalibModelParameters",
+    "extrinsicOpticToUserTrans",
+    "extrinsicOpticToUserRot",
+]
+
+
+def read_rec_timestamps(stream) -> np.ndarray:
+    """Read the acquisition timestamps of all the frames of a stream,
+    without reading the image data. The timestamp field is looked up
+    among the assumed iVA field names of
+    h5_to_pcd_converter.TIMESTAMP_FIELDS.
+
+    :raises ValueError: if the stream does not contain any timestamp field.
+    """
+    from h5_to_pcd_converter import TIMESTAMP_FIELDS, timestamp_field
+
+    field = timestamp_field(stream)
+    if field is None:
+        raise ValueError(
+            f"No timestamp field found in stream {stream.name}, "
+            f"expected one of {TIMESTAMP_FIELDS}."
+        )
+    timestamps = stream.fields(field)[:]
+    if timestamps.ndim > 1:
+        timestamps = timestamps[:, 0]
+    return timestamps.astype(np.int64)
+
+
+def match_timestamps(timestamps_2d, timestamps_3d, tolerance_ns):
+    """Find for each 3D frame the closest 2D frame in time.
+
+    :return: the indices of the matched 2D and 3D frames. 3D frames
+             without any 2D frame within the tolerance are left out.
+    """
+    if len(timestamps_2d) == 0 or len(timestamps_3d) == 0:
+        return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp)
+    order = np.argsort(timestamps_2d, kind="stable")
+    sorted_2d = timestamps_2d[order]
+    position = np.searchsorted(sorted_2d, timestamps_3d)
+    before = np.clip(position - 1, 0, sorted_2d.size - 1)
+    after = np.clip(position, 0, sorted_2d.size - 1)
+    closest = np.where(
+        np.abs(sorted_2d[after] - timestamps_3d)
+        < np.abs(sorted_2d[before] - timestamps_3d),
+        after,
+        before,
+    )
+    matched = np.abs(sorted_2d[closest] - timestamps_3d) <= tolerance_ns
+    return order[closest[matched]], np.flatnonzero(matched)
+
+
+# State of the batch processing workers: each worker opens the
+# recording once, and keeps its own registration object.
+_rec_worker = {}
+
+
+def _init_rec_worker(file_path, rgb_stream, tof_stream, output_prefix):
+    import h5py
+    from h5_to_pcd_converter import tof_frames_view
+
+    hf1 = h5py.File(file_path, "r")
+    _rec_worker["file"] = hf1
+    _rec_worker["rgb"] = hf1["streams"][rgb_stream]
+    # When the stream is memory mapped, the workers
+    # share the pages of the mapped file
+    _rec_worker["tof"] = tof_frames_view(hf1["streams"][tof_stream], TOF_REC_FIELDS)
+    _rec_worker["output_prefix"] = output_prefix
+    _rec_worker["registration"] = None
+
+
+def _colorize_rec_frames(pairs) -> int:
+    """Colorize the given pairs of 2D and 3D frames of the recording
+    opened by the worker, and save each colored cloud to a .npz file.
+
+    :return: the number of colored clouds written.
+    """
+    for index_2d, index_3d in pairs:
+        rgb = _rec_worker["rgb"][index_2d]
+        tof = _rec_worker["tof"][index_3d]
+        calibration = (
+            rgb["invIntrinsicCalibModelID"],
+            rgb["invIntrinsicCalibModelParameters"],
+            extrinsic_from_rec(rgb),
+            tof["intrinsicCalibModelID"],
+            tof["intrinsicCalibModelParameters"],
+            extrinsic_from_rec(tof),
+        )
+        registration = _rec_worker["registration"]
+        if registration is None:
+            registration = _rec_worker["registration"] = Registration2D3D(*calibration)
+        else:
+            registration.update(*calibration)
+
+        dis = tof["distance"]
+        points, colors = registration.colorize(decode_jpeg(rgb["jpeg"]), dis)
+        valid = dis.flatten() > MIN_VALID_DISTANCE
+        np.savez(
+            f"{_rec_worker['output_prefix']}_{tof['frameCounter']}.npz",
+            points=points[:, valid].T.astype(np.float32),
+            colors=colors[valid],
+        )
+    return len(pairs)
+
+
+def colorize_recording(
+    file_path: str,
+    rgb_stream: str = "o3r_rgb_0",
+    tof_stream: str = "o3r_tof_0",
+    output_dir: str = None,
+    tolerance_ns: int = DEFAULT_TOLERANCE_NS,
+    workers: int = None,
+    chunk_size: int = 64,
+) -> int:
+    """Colorize all the frames of a recording in the ifm h5 format.
+
+    The RGB and TOF frames are matched by timestamp, and each colored
+    point cloud (valid points only) is saved to a .npz file, named after
+    the recording, the TOF stream and the frame counter. The frames are
+    spread over a pool of processes, each opening the recording itself.
+
+    :param output_dir: directory of the output files,
+                       defaults to the directory of the recording.
+    :param workers: number of processes, defaults to the number of cores.
+    :param chunk_size: number of frames handed to a process at once.
+    :return: the number of colored clouds written.
+    """
+    import h5py
+
+    with h5py.File(file_path, "r") as hf1:
+        try:
+            timestamps_2d = read_rec_timestamps(hf1["streams"][rgb_stream])
+            timestamps_3d = read_rec_timestamps(hf1["streams"][tof_stream])
+        except KeyError as e:
+            raise ValueError(
+                f"The recording does not contain the streams {rgb_stream} and {tof_stream}."
+            ) from e
+    indices_2d, indices_3d = match_timestamps(
+        timestamps_2d, timestamps_3d, tolerance_ns
+    )
+    print(f"{indices_3d.size} of {timestamps_3d.size} TOF frames matched")
+
+    if output_dir is None:
+        output_dir = os.path.dirname(os.path.abspath(file_path))
+    recording_name = os.path.splitext(os.path.basename(file_path))[0]
+    output_prefix = os.path.join(output_dir, f"{recording_name}_{tof_stream}")
+
+    pairs = list(zip(indices_2d.tolist(), indices_3d.tolist()))
+    chunks = [pairs[i : i + chunk_size] for i in range(0, len(pairs), chunk_size)]
+    init_args = (file_path, rgb_stream, tof_stream, output_prefix)
+    if workers == 1:
+        _init_rec_worker(*init_args)
+        written = sum(map(_colorize_rec_frames, chunks))
+        _rec_worker["file"].close()
+        return written
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=_init_rec_worker, initargs=init_args
+    ) as executor:
+        return sum(executor.map(_colorize_rec_frames, chunks))
+
+
+# %%#########################################
+# Optional visualization. matplotlib and open3d
+# are only imported when these functions are used.
+#############################################
+def plot_point_cloud(pt_cloud, title):
+    #############################################
+    # Some boilerplate for plotting the point clouds
+    #############################################
+    import matplotlib.pyplot as plt
+
+    fig = plt.figure(1)
+    plt.clf()
+    ax = fig.add_subplot(projection="3d")
+    plt.plot(*pt_cloud, ".", markersize=1)
+    plt.xlabel("X")
+    plt.ylabel("Y")
+    ax.set_zlabel("Z")
+    plt.title(title)
+    plt.show()
+
+
+def plot_images(jpg, dis, amp):
+    """Display the amplitude, distance and RGB images."""
+    import matplotlib.pyplot as plt
+
+    plt.figure(1)
+    plt.clf()
+
+    plt.subplot(2, 2, 1)
+    plt.title("log(Amplitude) image")
+    # plt.imshow(np.log(amp + 0.001), cmap="gray", interpolation="none")
+    plt.imshow(amp, cmap="gray", interpolation="none")
+    plt.colorbar()
+
+    plt.subplot(2, 2, 3)
+    plt.title("Distance image")
+    plt.imshow(dis, cmap="jet", interpolation="none")
+    plt.colorbar()
+
+    plt.subplot(1, 2, 2)
+    plt.title("RGB image")
+    plt.imshow(jpg, interpolation="none")
+    plt.show()
+
+
+def display_colored_point_cloud(pt_cloud, colors, valid):
+    """Display the valid points of a colored point cloud with open3d."""
+    import open3d as o3d
+
+    point_cloud_colored = o3d.geometry.PointCloud()
+    point_cloud_colored.points = o3d.utility.Vector3dVector(pt_cloud[:, valid].T)
+    point_cloud_colored.colors = o3d.utility.Vector3dVector(colors[valid] / 255)
+    o3d.visualization.draw_geometries(
+        [point_cloud_colored], window_name="Colored point cloud"
+    )
+
+
+def display_stream(ip: str, port2d: str, port3d: str):
+    """Display the colored point clouds streamed from the camera."""
+    import open3d as o3d
+
+    vis = o3d.visualization.Visualizer()
+    vis.create_window("Colored point cloud")
+    point_cloud_colored = o3d.geometry.PointCloud()
+    first = True
+    for cloud in stream_colored_point_clouds(ip=ip, port2d=port2d, port3d=port3d):
+        point_cloud_colored.points = o3d.utility.Vector3dVector(
+            cloud.points[:, cloud.valid].T
+        )
+        point_cloud_colored.colors = o3d.utility.Vector3dVector(
+            cloud.colors[cloud.valid] / 255
+        )
+        if first:
+            vis.add_geometry(point_cloud_colored)
+            first = False
+        else:
+            vis.update_geometry(point_cloud_colored)
+        if not vis.poll_events():
+            break
+        vis.update_renderer()
+    vis.destroy_window()
+
+
 # %%#########################################
 # Main function which shows the step by step
 # registration of the 2D and 3D images
 #############################################
-def main(ip, port2d, port3d, use_recorded_data, file_path, show_open3d):
+def main(ip, port2d, port3d, use_recorded_data, file_path, show_open3d, show_plots):
     ############################################
     # Load recorded data in h5 format. We expect
     # data to be in the format provided by the
@@ -405,25 +1226,8 @@ def main(ip, port2d, port3d, use_recorded_data, file_path, show_open3d):
     ############################################
     # Review sample data using matplotlib
     ############################################
-
-    plt.figure(1)
-    plt.clf()
-
-    plt.subplot(2, 2, 1)
-    plt.title("log(Amplitude) image")
-    # plt.imshow(np.log(amp + 0.001), cmap="gray", interpolation="none")
-    plt.imshow(amp, cmap="gray", interpolation="none")
-    plt.colorbar()
-
-    plt.subplot(2, 2, 3)
-    plt.title("Distance image")
-    plt.imshow(dis, cmap="jet", interpolation="none")
-    plt.colorbar()
-
-    plt.subplot(1, 2, 2)
-    plt.title("RGB image")
-    plt.imshow(jpg, interpolation="none")
-    plt.show()
+    if show_plots:
+        plot_images(jpg, dis, amp)
 
     ############################################
     # Colorize the point cloud
@@ -438,28 +1242,17 @@ def main(ip, port2d, port3d, use_recorded_data, file_path, show_open3d):
         modelID3D,
         intrinsics3D,
         extrinsicO2U3D,
+        show_plots=show_plots,
     )
     ############################################
     # Visualize the colored point cloud
     #############################################
-    valid = dis.flatten() > 0.05
-    print(f"{round(sum(valid)/pt_cloud_in_user[0].size*100)}% valid pts")
-    for i, pt_valid in enumerate(valid):
-        if not pt_valid:
-            pt_cloud_in_user[0][i] = pt_cloud_in_user[1][i] = pt_cloud_in_user[0][
-                i
-            ] = 0.0
-
-    point_cloud_colored = o3d.geometry.PointCloud()
-    point_cloud_colored.points = o3d.utility.Vector3dVector(
-        pt_cloud_in_user.reshape(3, -1)[:, valid].T
-    )
-    point_cloud_colored.colors = o3d.utility.Vector3dVector(colors[valid] / 255)
+    valid = dis.flatten() > MIN_VALID_DISTANCE
+    print(f"{round(np.count_nonzero(valid)/pt_cloud_in_user[0].size*100)}% valid pts")
+    pt_cloud_in_user[:, ~valid] = 0.0
 
     if show_open3d:
-        o3d.visualization.draw_geometries(
-            [point_cloud_colored], window_name="Colored point cloud"
-        )
+        display_colored_point_cloud(pt_cloud_in_user, colors, valid)
 
     # %%
 
@@ -473,6 +1266,12 @@ if __name__ == "__main__":
     # If multiple frames are available in the file,
     # then the first frame will be used.
     USE_RECORDED_DATA = False
+    # Alternatively, continuously display the colored
+    # point clouds streamed from the camera.
+    STREAM_LIVE_DATA = False
+    # Or colorize all the frames of the recording and save
+    # them to .npz files, next to the recording.
+    BATCH_PROCESS_RECORDING = False
 
     ############################################
     # Import the device configuration from the config file
@@ -484,7 +1283,7 @@ if __name__ == "__main__":
         IP = config.IP
         PORT2D = config.PORT_2D
         PORT3D = config.PORT_3D
-        if USE_RECORDED_DATA:
+        if USE_RECORDED_DATA or BATCH_PROCESS_RECORDING:
             FILE_PATH = config.SAMPLE_DATA
 
     except ImportError:
@@ -496,18 +1295,28 @@ if __name__ == "__main__":
         IP = "192.168.0.69"
         PORT2D = "port0"
         PORT3D = "port2"
-        if USE_RECORDED_DATA:
+        if USE_RECORDED_DATA or BATCH_PROCESS_RECORDING:
             FILE_PATH = "./test_rec.h5"
 
     # Show 3D cloud or not.
     SHOW_OPEN3D = True
-    if not USE_RECORDED_DATA:
+    # Plot the images and the point cloud after each
+    # registration step or not (requires matplotlib).
+    SHOW_PLOTS = True
+    if not USE_RECORDED_DATA and not BATCH_PROCESS_RECORDING:
         FILE_PATH = ""
-    main(
-        ip=IP,
-        port2d=PORT2D,
-        port3d=PORT3D,
-        use_recorded_data=USE_RECORDED_DATA,
-        file_path=FILE_PATH,
-        show_open3d=SHOW_OPEN3D,
-    )
+    if STREAM_LIVE_DATA:
+        display_stream(ip=IP, port2d=PORT2D, port3d=PORT3D)
+    elif BATCH_PROCESS_RECORDING:
+        written = colorize_recording(file_path=FILE_PATH)
+        print(f"{written} colored point clouds written")
+    else:
+        main(
+            ip=IP,
+            port2d=PORT2D,
+            port3d=PORT3D,
+            use_recorded_data=USE_RECORDED_DATA,
+            file_path=FILE_PATH,
+            show_open3d=SHOW_OPEN3D,
+            show_plots=SHOW_PLOTS,
+        )